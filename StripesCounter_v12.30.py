@@ -4,7 +4,7 @@
 # Author: Patrick Brockmann CEA/DRF/LSCE - May 2022
 #=================================================================
 
-import sys, os
+import sys, os, zlib, struct
 
 #======================================================
 try: 
@@ -20,27 +20,34 @@ try:
     from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
     from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
     from matplotlib.figure import Figure
-    from matplotlib.transforms import Bbox
     from matplotlib.collections import LineCollection
     import matplotlib.patches as patches
     import matplotlib.pyplot as plt
     
-    from skimage.measure import profile_line
-    import peakutils
     
     import numpy as np
     import cv2
+    import shapely
     from shapely.geometry import Point, LineString
 
+    from stripes_profile import refinePeaks, findPeaks, smoothProfile, smoothingMethods, sweepPeaks, estimatePeriod
+    from stripes_profile import profileCoordinates, sampleProfileCoordinates, splinePath, splineCoordinates
+    from stripes_profile import interpolationOrders, widthReductions, reduceProfile
+    from stripes_detection import detectStripes
+    from stripes_scale import detectScale, detectScales, OCRPool, imageHash, ScaleCache
+    from stripes_timing import timings, timed
+    from stripes_session import recorder, recorded, loadSession, replaySession
+    from stripes_memory import buffersBytes
+
     import datetime
     import pandas as pd
+    from collections import OrderedDict
 
-    import cairo
-    import xml.dom.minidom
+    from xml.sax.saxutils import quoteattr
 
 except:
     print("Some modules have not been found:")
-    print("---> re, matplotlib, PyQt5, skimage, peakutils, numpy, cv2, shapely, cairo, xml")
+    print("---> re, matplotlib, PyQt5, scipy, numpy, cv2, shapely, pandas, xml, stripes_profile, stripes_detection, stripes_scale, stripes_timing, stripes_session, stripes_memory")
     sys.exit()
 
 #======================================================
@@ -50,6 +57,87 @@ maximumWidth = 250
 windowWidth = 1400
 windowHeight = 900
 
+stripHeight = 1024              # rows rendered at once when saving full resolution images
+pyramidMinSize = 1024           # largest dimension of the coarsest pyramid level
+periodTolerance = 0.2           # relative difference between peaks and spectral stripe rates flagged
+detectionTileSize = 512         # size of the tiles (and length of the growth axes) of the automatic detection
+memoryBudget = 4096             # MB of the image buffers and caches before the caches are evicted
+workspaceSize = 4               # images kept resident besides the displayed one
+
+#======================================================
+def writePNG(fileName, strips, width, height):
+    # Grayscale 8 bits PNG written from an iterator of strips of rows,
+    # the compressed stream being flushed to the file as strips arrive
+    def chunk(f, tag, data):
+        f.write(struct.pack('>I', len(data)) + tag + data)
+        f.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    with open(fileName, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+        compressor = zlib.compressobj(1)
+        for strip in strips:
+            rows = np.zeros((strip.shape[0], width+1), dtype=np.uint8)       # filter type 0 for each row
+            rows[:,1:] = strip
+            data = compressor.compress(rows.tobytes())
+            if data:
+                chunk(f, b'IDAT', data)
+        chunk(f, b'IDAT', compressor.flush())
+        chunk(f, b'IEND', b'')
+
+#======================================================
+def svgCoords(xy, separator):
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    return separator.join(['%.2f %.2f'] * len(xy)) % tuple(xy.ravel())
+
+#======================================================
+def svgTicks(bounds):
+    # ticks of a segment batched as the subpaths of a single path
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    return ' '.join(['M%.2f %.2f L%.2f %.2f'] * len(bounds)) % tuple(bounds.ravel())
+
+#======================================================
+class SweepDialog(QDialog):
+
+    #------------------------------------------------------------------
+    def __init__(self, parent, thresholds, minDists, counts, rates):
+        QDialog.__init__(self, parent)
+        self.setWindowTitle("Sweep of peaks parameters")
+        self.resize(900, 700)
+        self.parent = parent
+        self.thresholds = thresholds
+        self.minDists = minDists
+
+        self.fig = Figure(figsize=(8,7))
+        self.canvas = FigureCanvas(self.fig)
+        self.canvas.mpl_connect('button_press_event', self.on_press)
+        extent = [thresholds[0]-0.5, thresholds[-1]+0.5, minDists[-1]+0.5, minDists[0]-0.5]
+        self.axes = []
+        for n, (data, title) in enumerate([(counts, "Number of peaks"), (rates, "Growth stripe rate (mm/stripe)")]):
+            ax = self.fig.add_subplot(2, 1, n+1)
+            im = ax.imshow(data, aspect='auto', extent=extent, interpolation='nearest', cmap='viridis')
+            self.fig.colorbar(im, ax=ax)
+            ax.set_title(title, fontsize=10)
+            ax.set_ylabel("Minimum distance")
+            ax.plot(parent.peakutils_thres, parent.peakutils_minDist, marker='+', c='red', ms=12)
+            self.axes.append(ax)
+        self.axes[-1].set_xlabel("Threshold (click to select)")
+        self.fig.tight_layout()
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.canvas)
+        self.setLayout(layout)
+
+    #------------------------------------------------------------------
+    def on_press(self, event):
+        if event.inaxes not in self.axes: return
+        thres = int(np.clip(round(event.xdata), self.thresholds[0], self.thresholds[-1]))
+        minDist = int(np.clip(round(event.ydata), self.minDists[0], self.minDists[-1]))
+        for ax in self.axes:
+            ax.lines[-1].set_data([thres], [minDist])
+        self.canvas.draw()
+        self.parent.selectPeaksParameters(thres, minDist)
+
 #======================================================
 class MainWindow(QMainWindow):
 
@@ -57,6 +145,11 @@ class MainWindow(QMainWindow):
     def __init__(self):
         QMainWindow.__init__(self)
 
+        self.scaleCache = ScaleCache()
+        self.ocrPool = None                 # OCR workers kept for all scale detections
+        self.memoryBudget = memoryBudget
+        self.workspace = OrderedDict()      # LRU of the states of the previously opened images
+        self.currentFileName = None
         self.initValues()
 
         #-------------------------------
@@ -69,6 +162,11 @@ class MainWindow(QMainWindow):
         openAction.setStatusTip('Open document')
         openAction.triggered.connect(self.openCall)
 
+        # Create batch scale detection action
+        scalesAction = QAction('&Detect scales of images...', self)
+        scalesAction.setStatusTip('Detect and cache the scales of several images')
+        scalesAction.triggered.connect(self.batchDetectScales)
+
         # Create exit action
         exitAction = QAction(QIcon('exit.png'), '&Exit', self)        
         exitAction.setShortcut('Ctrl+Q')
@@ -85,7 +183,31 @@ class MainWindow(QMainWindow):
         self.menuBar = self.menuBar()
         fileMenu = self.menuBar.addMenu('&File')
         fileMenu.addAction(openAction)
+        fileMenu.addAction(scalesAction)
+        self.workspaceMenu = fileMenu.addMenu('&Switch image')
+        self.workspaceMenu.aboutToShow.connect(self.updateWorkspaceMenu)
         fileMenu.addAction(exitAction)
+        toolsMenu = self.menuBar.addMenu('&Tools')
+        timingsAction = QAction('&Record timings', self, checkable=True)
+        timingsAction.setStatusTip('Record the latencies of display and interactions')
+        timingsAction.toggled.connect(self.toggled_timings)
+        toolsMenu.addAction(timingsAction)
+        exportTimingsAction = QAction('&Export timings...', self)
+        exportTimingsAction.setStatusTip('Save the recorded latencies as JSON')
+        exportTimingsAction.triggered.connect(self.exportTimings)
+        toolsMenu.addAction(exportTimingsAction)
+        sessionAction = QAction('Record &session', self, checkable=True)
+        sessionAction.setStatusTip('Record the interactions to replay them')
+        sessionAction.toggled.connect(self.toggled_session)
+        toolsMenu.addAction(sessionAction)
+        saveSessionAction = QAction('Save recorded session...', self)
+        saveSessionAction.setStatusTip('Save the recorded interactions as JSON')
+        saveSessionAction.triggered.connect(self.saveSession)
+        toolsMenu.addAction(saveSessionAction)
+        budgetAction = QAction('&Memory budget...', self)
+        budgetAction.setStatusTip('Define the memory used by the image buffers and caches')
+        budgetAction.triggered.connect(self.defineMemoryBudget)
+        toolsMenu.addAction(budgetAction)
         fileMenu = self.menuBar.addMenu('&About')
         fileMenu.addAction(aboutAction)
 
@@ -124,6 +246,12 @@ class MainWindow(QMainWindow):
         self.mySliderBeta.setTickPosition(QSlider.TicksBelow)
         self.mySliderBeta.valueChanged[int].connect(self.changeValueBeta)
 
+        self.comboSmoothing = QComboBox(self)
+        self.comboSmoothing.setMaximumWidth(maximumWidth)
+        for method, name in smoothingMethods.items():
+            self.comboSmoothing.addItem("Smoothing: " + name, method)
+        self.comboSmoothing.currentIndexChanged[int].connect(self.changeSmoothing)
+
         self.mySliderKernelSize = QSlider(Qt.Horizontal, self)
         self.mySliderKernelSize.setMaximumWidth(maximumWidth)
         self.mySliderKernelSize.setMinimum(1)
@@ -169,12 +297,45 @@ class MainWindow(QMainWindow):
         self.cboxReverseProfile.setChecked(False)
         self.cboxReverseProfile.toggled.connect(self.toggled_cboxReverseProfile)
 
+        self.cboxSubPixelPeaks = QCheckBox("Sub-pixel peaks")
+        self.cboxSubPixelPeaks.setChecked(True)
+        self.cboxSubPixelPeaks.toggled.connect(self.toggled_cboxSubPixelPeaks)
+
+        self.comboInterpolation = QComboBox(self)
+        self.comboInterpolation.setMaximumWidth(maximumWidth)
+        for order, name in interpolationOrders.items():
+            self.comboInterpolation.addItem("Interpolation: " + name, order)
+        self.comboInterpolation.currentIndexChanged[int].connect(self.changeInterpolation)
+
+        self.comboReduction = QComboBox(self)
+        self.comboReduction.setMaximumWidth(maximumWidth)
+        for method, name in widthReductions.items():
+            self.comboReduction.addItem("Width reduction: " + name, method)
+        self.comboReduction.currentIndexChanged[int].connect(self.changeReduction)
+
+        self.labelPercentile = QLabel("Width percentile: " + str(self.reductionPercentile))
+        self.labelPercentile.setAlignment(Qt.AlignLeft)
+
+        self.mySliderPercentile = QSlider(Qt.Horizontal, self)
+        self.mySliderPercentile.setMaximumWidth(maximumWidth)
+        self.mySliderPercentile.setMinimum(0)
+        self.mySliderPercentile.setMaximum(100)
+        self.mySliderPercentile.setValue(self.reductionPercentile)
+        self.mySliderPercentile.setTickInterval(10)
+        self.mySliderPercentile.setTickPosition(QSlider.TicksBelow)
+        self.mySliderPercentile.valueChanged[int].connect(self.changeValuePercentile)
+
+        self.cboxSplineProfile = QCheckBox("Curved profile (spline)")
+        self.cboxSplineProfile.setChecked(False)
+        self.cboxSplineProfile.toggled.connect(self.toggled_cboxSplineProfile)
+
         #-----------------------
         self.fig = plt.figure(figsize=(8,8))
         self.ax0 = self.fig.add_axes([0.08, 0.40, 0.88, 0.52])   #  [left, bottom, width, height]
         self.ax1 = self.fig.add_axes([0.08, 0.12, 0.88, 0.22])
 
         self.canvas = FigureCanvas(self.fig)
+        self.canvas.draw = timings.wrap('canvas.draw', self.canvas.draw)
         # https://github.com/matplotlib/matplotlib/issues/707/
         self.canvas.setFocusPolicy(Qt.ClickFocus)
         self.canvas.setFocus()
@@ -202,6 +363,18 @@ class MainWindow(QMainWindow):
         self.buttonDefineScale.setMaximumWidth(maximumWidth)
         self.buttonDefineScale.clicked.connect(self.defineScale)
 
+        self.buttonSaveScalePattern = QPushButton('Save scale for file pattern')
+        self.buttonSaveScalePattern.setMaximumWidth(maximumWidth)
+        self.buttonSaveScalePattern.clicked.connect(self.saveScalePattern)
+
+        self.buttonSweep = QPushButton('Sweep peaks parameters')
+        self.buttonSweep.setMaximumWidth(maximumWidth)
+        self.buttonSweep.clicked.connect(self.sweepPeaksParameters)
+
+        self.buttonDetectStripes = QPushButton('Detect stripes automatically')
+        self.buttonDetectStripes.setMaximumWidth(maximumWidth)
+        self.buttonDetectStripes.clicked.connect(self.detectStripes)
+
         self.buttonExtract = QPushButton('Extract peaks from profile')
         self.buttonExtract.setMaximumWidth(maximumWidth)
         self.buttonExtract.clicked.connect(self.extract)
@@ -226,6 +399,10 @@ class MainWindow(QMainWindow):
         self.buttonSaveFullImage.setMaximumWidth(maximumWidth)
         self.buttonSaveFullImage.clicked.connect(self.saveFullImageSVG)
 
+        self.buttonSaveFullImagePNG = QPushButton('Save full image as PNG/TIFF')
+        self.buttonSaveFullImagePNG.setMaximumWidth(maximumWidth)
+        self.buttonSaveFullImagePNG.clicked.connect(self.saveFullImagePNG)
+
         layoutH = QHBoxLayout()
 
         layoutV1 = QVBoxLayout()
@@ -242,10 +419,16 @@ class MainWindow(QMainWindow):
         layoutV2.addWidget(self.mySliderBeta)
         layoutV2.addSpacing(1)
         layoutV2.addWidget(self.labelKernelSize)
+        layoutV2.addWidget(self.comboSmoothing)
         layoutV2.addWidget(self.mySliderKernelSize)
         layoutV2.addSpacing(1)
         layoutV2.addWidget(self.labelProfileLinewidth)
         layoutV2.addWidget(self.mySliderProfileLinewidth)
+        layoutV2.addWidget(self.comboInterpolation)
+        layoutV2.addWidget(self.comboReduction)
+        layoutV2.addWidget(self.labelPercentile)
+        layoutV2.addWidget(self.mySliderPercentile)
+        layoutV2.addWidget(self.cboxSplineProfile)
         layoutV2.addSpacing(1)
         layoutV2.addWidget(self.labelPeakUtils_minDist)
         layoutV2.addWidget(self.mySliderPeakUtils_minDist)
@@ -254,12 +437,16 @@ class MainWindow(QMainWindow):
         layoutV2.addWidget(self.mySliderPeakUtils_thres)
         layoutV2.addWidget(self.cboxPeaks)
         layoutV2.addWidget(self.cboxReverseProfile)
+        layoutV2.addWidget(self.cboxSubPixelPeaks)
+        layoutV2.addWidget(self.buttonSweep)
         layoutV2.addSpacing(1)
         layoutV2.addWidget(self.buttonDetectScale)
         layoutV2.addWidget(self.buttonDefineScaleValue)
         layoutV2.addWidget(self.buttonDefineScaleLength)
         layoutV2.addWidget(self.buttonDefineScale)
+        layoutV2.addWidget(self.buttonSaveScalePattern)
         layoutV2.addSpacing(20)
+        layoutV2.addWidget(self.buttonDetectStripes)
         layoutV2.addWidget(self.buttonExtract)
         layoutV2.addWidget(self.buttonLoad)
         layoutV2.addWidget(self.buttonSave)
@@ -269,6 +456,7 @@ class MainWindow(QMainWindow):
         layoutV2.addWidget(self.buttonDeleteLastSegment)
         layoutV2.addSpacing(20)
         layoutV2.addWidget(self.buttonSaveFullImage)
+        layoutV2.addWidget(self.buttonSaveFullImagePNG)
 
         layoutH.addLayout(layoutV1)
         layoutH.addLayout(layoutV2)
@@ -282,6 +470,13 @@ class MainWindow(QMainWindow):
         # Status bar
         self.status_bar = self.statusBar()
         self.status_bar.showMessage('Ready', 5000)
+        self.labelTimings = QLabel()
+        self.labelTimings.setVisible(False)
+        self.status_bar.addPermanentWidget(self.labelTimings)
+        self.timerTimings = QTimer(self)
+        self.timerTimings.timeout.connect(self.updateTimingsOverlay)
+        self.labelMemory = QLabel()
+        self.status_bar.addPermanentWidget(self.labelMemory)
 
         self.initInterface()
 
@@ -295,6 +490,8 @@ class MainWindow(QMainWindow):
 
         self.scaleValue = 0.
         self.scaleLength = 0
+        self.scalePoints = None
+        self.imageHash = None
 
         self.offset = [0,0]
         self.n = 0
@@ -310,18 +507,29 @@ class MainWindow(QMainWindow):
         self.shift_is_held = False
 
         self.kernelSize = 3 
+        self.smoothingMethod = 'box'
         self.kernelOffset = 0
         self.profileLinewidth = 1
+        self.interpolationOrder = 0
+        self.reductionMethod = 'mean'
+        self.reductionPercentile = 90
         self.peakutils_minDist = 1
         self.peakutils_thres = 125 
 
         self.lineWithWidth = None
+        self.curve_object = None
+        self.profileCache = OrderedDict()           # LRU of sampled profiles
+        self.profileCacheSize = 64
+        self.imageVersion = 0
         self.dist_profile = None
         self.profile = None
         self.profile_convolved = None
         self.indexes = None
+        self.positions = None
+        self.spectralRate = np.nan
         self.peaksCurve = None
         self.peaks = None
+        self.sweepDialog = None
         self.peakOver0 = None
         self.peakOver1 = None
         self.segmentNumb = 0
@@ -344,6 +552,9 @@ class MainWindow(QMainWindow):
         self.subSampling = 1
         self.imageDisplayedWidth = 0 
 
+        self.pyramid = []
+        self.imageResized = None
+        self.imageResizedAdjusted = None
         self.image_object = None
         self.text_subSampling = None
         self.image_title = None
@@ -356,6 +567,7 @@ class MainWindow(QMainWindow):
         self.labelBeta.setEnabled(False)
         self.mySliderBeta.setEnabled(False)
         self.labelKernelSize.setEnabled(False)
+        self.comboSmoothing.setEnabled(False)
         self.mySliderKernelSize.setEnabled(False)
         self.labelProfileLinewidth.setEnabled(False)
         self.mySliderProfileLinewidth.setEnabled(False)
@@ -364,18 +576,26 @@ class MainWindow(QMainWindow):
         self.labelPeakUtils_minDist.setEnabled(False)
         self.cboxPeaks.setEnabled(False)
         self.cboxReverseProfile.setEnabled(False)
+        self.cboxSubPixelPeaks.setEnabled(False)
+        self.cboxSplineProfile.setEnabled(False)
+        self.comboInterpolation.setEnabled(False)
+        self.comboReduction.setEnabled(False)
+        self.buttonSweep.setEnabled(False)
         self.mySliderPeakUtils_minDist.setEnabled(False)
         self.cboxPeaks.setChecked(False)
         self.buttonDetectScale.setEnabled(False)
         self.buttonDefineScale.setEnabled(False)
         self.buttonDefineScaleValue.setEnabled(False)
         self.buttonDefineScaleLength.setEnabled(False)
+        self.buttonSaveScalePattern.setEnabled(False)
         self.buttonCapture.setEnabled(False)
         self.buttonExtract.setEnabled(False)
+        self.buttonDetectStripes.setEnabled(False)
         self.buttonSave.setEnabled(False)
         self.buttonLoad.setEnabled(False)
         self.buttonDeleteLastSegment.setEnabled(False)
         self.buttonSaveFullImage.setEnabled(False)
+        self.buttonSaveFullImagePNG.setEnabled(False)
 
         self.cboxInverseImage.blockSignals(True)
         self.cboxInverseImage.setChecked(False)
@@ -383,6 +603,19 @@ class MainWindow(QMainWindow):
         self.cboxReverseProfile.setChecked(False)
 
         self.mySliderKernelSize.setValue(self.kernelSize)
+        self.comboSmoothing.setCurrentIndex(list(smoothingMethods).index(self.smoothingMethod))
+        self.comboInterpolation.blockSignals(True)
+        self.comboInterpolation.setCurrentIndex(self.comboInterpolation.findData(self.interpolationOrder))
+        self.comboInterpolation.blockSignals(False)
+        self.comboReduction.blockSignals(True)
+        self.comboReduction.setCurrentIndex(self.comboReduction.findData(self.reductionMethod))
+        self.comboReduction.blockSignals(False)
+        self.mySliderPercentile.blockSignals(True)
+        self.mySliderPercentile.setValue(self.reductionPercentile)
+        self.mySliderPercentile.blockSignals(False)
+        self.labelPercentile.setText("Width percentile: " + str(self.reductionPercentile))
+        self.labelPercentile.setEnabled(False)
+        self.mySliderPercentile.setEnabled(False)
         self.mySliderProfileLinewidth.setValue(self.profileLinewidth)
         self.mySliderPeakUtils_minDist.setValue(self.peakutils_minDist)
         self.mySliderPeakUtils_thres.setValue(self.peakutils_thres)
@@ -391,6 +624,7 @@ class MainWindow(QMainWindow):
         self.ax1.set_visible(False)
 
     #------------------------------------------------------------------
+    @recorded('changeValueAlpha')
     def changeValueAlpha(self, value):
         self.alphaLevel = value/10.
         self.labelAlpha.setText("Contrast level: " + str(self.alphaLevel))
@@ -399,14 +633,19 @@ class MainWindow(QMainWindow):
         self.canvas.draw()
 
     #------------------------------------------------------------------
-    def toggled_cboxInverseImage(self):
+    @recorded('toggled_cboxInverseImage')
+    def toggled_cboxInverseImage(self, checked):
         self.image = cv2.bitwise_not(self.image)
+        self.imageVersion += 1
+        self.buildPyramid()
         self.sampleImage()
+        self.updateMemory()
         self.displayImage()
         self.drawProfile(resetAxis=False)
         self.canvas.draw()
 
     #------------------------------------------------------------------
+    @recorded('changeValueBeta')
     def changeValueBeta(self, value):
         self.betaLevel = value
         self.labelBeta.setText("Brighness level: " + str(self.betaLevel))
@@ -415,6 +654,7 @@ class MainWindow(QMainWindow):
         self.canvas.draw()
 
     #------------------------------------------------------------------
+    @recorded('changeValueKernelSize')
     def changeValueKernelSize(self, value):
         if value % 2 != 0:
             self.kernelSize = value
@@ -422,6 +662,32 @@ class MainWindow(QMainWindow):
             self.drawProfile(resetAxis=False)
 
     #------------------------------------------------------------------
+    @recorded('changeSmoothing')
+    def changeSmoothing(self, index):
+        self.smoothingMethod = self.comboSmoothing.itemData(index)
+        self.drawProfile(resetAxis=False)
+
+    #------------------------------------------------------------------
+    @recorded('changeInterpolation')
+    def changeInterpolation(self, index):
+        self.interpolationOrder = self.comboInterpolation.itemData(index)
+        self.drawProfile(resetAxis=False)
+
+    #------------------------------------------------------------------
+    @recorded('changeReduction')
+    def changeReduction(self, index):
+        self.reductionMethod = self.comboReduction.itemData(index)
+        self.drawProfile(resetAxis=False)
+
+    #------------------------------------------------------------------
+    @recorded('changeValuePercentile')
+    def changeValuePercentile(self, value):
+        self.reductionPercentile = value
+        self.labelPercentile.setText("Width percentile: " + str(self.reductionPercentile))
+        self.drawProfile(resetAxis=False)
+
+    #------------------------------------------------------------------
+    @recorded('changeValueProfileLinewidth')
     def changeValueProfileLinewidth(self, value):
         self.profileLinewidth= value
         self.labelProfileLinewidth.setText("Profile linewidth: " + str(self.profileLinewidth))
@@ -430,26 +696,45 @@ class MainWindow(QMainWindow):
         self.drawProfile(resetAxis=False)
 
     #------------------------------------------------------------------
+    @recorded('changeValuePeakUtils_minDist')
     def changeValuePeakUtils_minDist(self, value):
         self.peakutils_minDist = value
         self.labelPeakUtils_minDist.setText("PeakUtils - Minimum distance: " + str(self.peakutils_minDist))
         self.drawProfile(resetAxis=False)
         
     #------------------------------------------------------------------
+    @recorded('changeValuePeakUtils_thres')
     def changeValuePeakUtils_thres(self, value):
         self.peakutils_thres = value
         self.labelPeakUtils_thres.setText("PeakUtils - Threshold: %d" % self.peakutils_thres)
         self.drawProfile(resetAxis=False)
 
     #------------------------------------------------------------------
-    def toggled_cboxPeaks(self):
+    @recorded('toggled_cboxPeaks')
+    def toggled_cboxPeaks(self, checked):
+        self.drawProfile(resetAxis=False)
+
+    #------------------------------------------------------------------
+    @recorded('toggled_cboxReverseProfile')
+    def toggled_cboxReverseProfile(self, checked):
         self.drawProfile(resetAxis=False)
 
     #------------------------------------------------------------------
-    def toggled_cboxReverseProfile(self):
+    @recorded('toggled_cboxSubPixelPeaks')
+    def toggled_cboxSubPixelPeaks(self, checked):
         self.drawProfile(resetAxis=False)
 
     #------------------------------------------------------------------
+    @recorded('toggled_cboxSplineProfile')
+    def toggled_cboxSplineProfile(self, checked):
+        if self.line_object is None: return
+        self.update_lineWithWidth()
+        self.canvas.draw()
+        self.drawProfile(resetAxis=True)
+
+    #------------------------------------------------------------------
+    @timed('zoom')
+    @recorded('zoom')
     def zoom(self, event):
         try:
             # https://stackoverflow.com/questions/11551049/matplotlib-plot-zooming-with-scroll-wheel
@@ -492,6 +777,7 @@ class MainWindow(QMainWindow):
             return
 
     #------------------------------------------------------------------
+    @recorded('on_release')
     def on_release(self, event):
         if event.key == 'shift':
             self.shift_is_held = False
@@ -504,6 +790,7 @@ class MainWindow(QMainWindow):
         self.canvas.draw()
 
     #------------------------------------------------------------------
+    @recorded('on_pick')
     def on_pick(self, event):
 
         if event.mouseevent.button == 3:
@@ -555,6 +842,8 @@ class MainWindow(QMainWindow):
         self.canvas.draw()
 
     #------------------------------------------------------------------
+    @timed('on_motion')
+    @recorded('on_motion')
     def on_motion(self, event):
 
         self.clearPeaksOver()
@@ -654,6 +943,7 @@ class MainWindow(QMainWindow):
                 self.canvas.draw()
 
     #------------------------------------------------------------------
+    @recorded('on_press')
     def on_press(self, event):
         self.clearPeaksOver()
 
@@ -665,32 +955,37 @@ class MainWindow(QMainWindow):
         if event.key == 'shift':
             self.shift_is_held = True
         if event.inaxes == self.ax0 or event.inaxes == self.ax1:
-            self.cur_xlim = event.inaxes.get_xlim()
-            self.cur_ylim = event.inaxes.get_ylim()
+            self.cur_xlim = np.asarray(event.inaxes.get_xlim())
+            self.cur_ylim = np.asarray(event.inaxes.get_ylim())
             self.xpress = event.xdata
             self.ypress = event.ydata
-        if event and event.dblclick and self.shift_is_held:
-            if len(self.listLabelPoints) < 2:
-                self.n = self.n+1
-                x, y = event.xdata, event.ydata
-                newPointLabel = "Point%d"%self.n
-                point_object = patches.Circle([x, y], radius=self.radius, color='red', fill=False, lw=2,
-                                              alpha=self.alpha_low, transform=self.ax0.transData, label=newPointLabel)
-                point_object.set_picker(5)
-                self.ax0.add_patch(point_object)
-                self.listLabelPoints.append(newPointLabel)
-                if len(self.listLabelPoints) == 2:
-                    xdata = []
-                    ydata = []
-                    for p in list(self.ax0.patches):
-                        cx, cy = p.center
-                        xdata.append(cx)
-                        ydata.append(cy)
-                    self.line_object, = self.ax0.plot(xdata, ydata, alpha=self.alpha_low, c='red', lw=2, 
-                                                        picker=True, pickradius=5, label="Profile")
-                    self.update_lineWithWidth()
-                self.canvas.draw()
-                self.drawProfile(resetAxis=True)
+        if event and event.dblclick and self.shift_is_held and event.inaxes == self.ax0:
+            # a profile is a polyline of any number of control points
+            self.n = self.n+1
+            x, y = event.xdata, event.ydata
+            newPointLabel = "Point%d"%self.n
+            point_object = patches.Circle([x, y], radius=self.radius, color='red', fill=False, lw=2,
+                                          alpha=self.alpha_low, transform=self.ax0.transData, label=newPointLabel)
+            point_object.set_picker(5)
+            self.ax0.add_patch(point_object)
+            self.listLabelPoints.append(newPointLabel)
+            if len(self.listLabelPoints) == 2:
+                xdata = []
+                ydata = []
+                for p in list(self.ax0.patches):
+                    cx, cy = p.center
+                    xdata.append(cx)
+                    ydata.append(cy)
+                self.line_object, = self.ax0.plot(xdata, ydata, alpha=self.alpha_low, c='red', lw=2, 
+                                                    picker=True, pickradius=5, label="Profile")
+                self.update_lineWithWidth()
+            elif len(self.listLabelPoints) > 2:
+                xdata = list(self.line_object.get_xdata()) + [x]
+                ydata = list(self.line_object.get_ydata()) + [y]
+                self.line_object.set_data(xdata, ydata)
+                self.update_lineWithWidth()
+            self.canvas.draw()
+            self.drawProfile(resetAxis=True)
 
         #----------------------------------------------
         if event.inaxes == self.ax0 and len(self.segmentList) != 0 and self.line_object == None:
@@ -700,7 +995,7 @@ class MainWindow(QMainWindow):
                    if self.mousepress == "left":
                       xdata = list(segment.get_xdata())
                       ydata = list(segment.get_ydata())
-                      line = LineString([(xdata[0], ydata[0]), (xdata[1], ydata[1])])
+                      line = LineString(list(zip(xdata, ydata)))
                       point = Point(event.xdata, event.ydata)
                       # Closest point on the line
                       newPoint = line.interpolate(line.project(point))
@@ -711,11 +1006,8 @@ class MainWindow(QMainWindow):
                       ticks = self.ticksCollectionList[n].get_segments()
                       ticks.append(tick[0])
                       # sort peaks along the segment after peak add
-                      posDistance = []
-                      for p in newPosPeaks:
-                          distance = Point(xdata[0], ydata[0]).distance(Point(p))
-                          posDistance.append(distance)
-                      sortIndices = np.argsort(posDistance)
+                      posDistance = shapely.line_locate_point(line, shapely.points(np.asarray(newPosPeaks, dtype=float)))
+                      sortIndices = np.argsort(posDistance, kind='stable')
                       newPosPeaks = newPosPeaks[sortIndices]
                       self.peaksExtractedList[n].set_offsets(newPosPeaks)
                       newTicks = np.array(ticks)[sortIndices]
@@ -750,6 +1042,7 @@ class MainWindow(QMainWindow):
             self.scalePixel = 1
 
     #------------------------------------------------------------------
+    @timed('drawProfile')
     def drawProfile(self, resetAxis=False):
         if self.line_object is None:
             return 
@@ -765,16 +1058,13 @@ class MainWindow(QMainWindow):
             self.profile_my = np.array([])
             self.dist_profile = np.array([])
 
-            self.imageAdjusted = cv2.convertScaleAbs(self.image, alpha=self.alphaLevel, beta=self.betaLevel)
-            self.profile = profile_line(self.imageAdjusted, (ydata[0], xdata[0]), (ydata[1], xdata[1]),
-                                        order=0, mode='constant', cval=0, linewidth=self.profileLinewidth)
-
-            self.profile_mx = profile_line(self.mx, (ydata[0], xdata[0]), (ydata[1], xdata[1]),
-                                        order=0, mode='constant', cval=0, linewidth=self.profileLinewidth)
-            self.profile_my = profile_line(self.my, (ydata[0], xdata[0]), (ydata[1], xdata[1]),
-                                        order=0, mode='constant', cval=0, linewidth=self.profileLinewidth)
+            self.profile, self.profile_mx, self.profile_my = self.sampleProfile(xdata, ydata)
 
-            self.dist_profile = np.linspace(0, self.scalePixel*len(self.profile), num=len(self.profile))
+            # cumulative distances along the profile and at its vertices
+            steps = np.hypot(np.diff(self.profile_mx), np.diff(self.profile_my))
+            self.dist_profile = self.scalePixel * np.concatenate([[0.], np.cumsum(steps)])
+            path = LineString(self.profilePath(xdata, ydata))
+            dist_vertices = self.scalePixel * shapely.line_locate_point(path, shapely.points(xdata[1:], ydata[1:]))
 
             if not resetAxis: 
                 xlim = self.ax1.get_xlim()
@@ -788,45 +1078,57 @@ class MainWindow(QMainWindow):
             self.ax1.plot(self.dist_profile, self.profile, c='red', lw=1, alpha=self.alpha_high)
 
             self.ax1.axvline(x=0, linestyle='dashed', color='gray', alpha=self.alpha_high)
-            self.ax1.axvline(x=self.dist_profile[-1], linestyle='dashed', color='gray', alpha=self.alpha_high)
+            for dist in dist_vertices:
+                self.ax1.axvline(x=dist, linestyle='dashed', color='gray', alpha=self.alpha_high)
             
-            kernel = np.ones(self.kernelSize) / self.kernelSize
             self.kernelOffset = int(self.kernelSize/2)
             
-            # use mode='same' and put boundaries values to np.nan
-            self.profile_convolved = np.convolve(self.profile, kernel, mode='same')
-            self.profile_convolved[0:self.kernelOffset] = self.profile_convolved[-self.kernelOffset:] = np.nan
+            # boundaries values are put to np.nan
+            self.profile_convolved = smoothProfile(self.profile, self.kernelSize, self.smoothingMethod)
 
             self.ax1.plot(self.dist_profile, self.profile_convolved, c='b', lw=1, alpha=self.alpha_high)
             
+            # same peaks as peakutils.indexes with thres_abs=True
             # https://peakutils.readthedocs.io/en/latest/reference.html
-            self.indexes = peakutils.indexes(self.profile_convolved, thres=self.peakutils_thres, thres_abs=True, min_dist=self.peakutils_minDist)
-            self.peaksCurve = self.ax1.scatter(self.dist_profile[self.indexes], self.profile_convolved[self.indexes], c='b', s=10)
+            self.indexes = findPeaks(self.profile_convolved, thres=self.peakutils_thres, min_dist=self.peakutils_minDist)
+
+            # positions of peaks as fractional sample indexes
+            if self.cboxSubPixelPeaks.isChecked():
+                self.positions = refinePeaks(self.profile_convolved, self.indexes)
+            else:
+                self.positions = self.indexes.astype(float)
+            samples = np.arange(len(self.profile))
+            distPeaks = np.interp(self.positions, samples, self.dist_profile)
+            self.peaksCurve = self.ax1.scatter(distPeaks, self.profile_convolved[self.indexes], c='b', s=10)
+
+            # dominant period of the smoothed profile as a cross-check of the peaks counting
+            samplePeriod = estimatePeriod(self.profile_convolved)
+            self.spectralRate = samplePeriod * (self.dist_profile[-1]-self.dist_profile[0]) / max(len(self.dist_profile)-1, 1)
 
             if self.peaks != None:
                 self.peaks.remove()
                 self.peaks = None
 
             if self.cboxPeaks.isChecked():
-                line = LineString([(xdata[0], ydata[0]), (xdata[1], ydata[1])])
-                points = []
-                for i in self.indexes:
-                    point = Point(self.profile_mx[i], self.profile_my[i])
-                    # Closest point on the line
-                    newPoint = line.interpolate(line.project(point))
-                    points.append(newPoint)
-                xs = [point.x for point in points]
-                ys = [point.y for point in points]
+                xs, ys = self.peaksOnProfile()
                 self.peaks = self.ax0.scatter(xs, ys, c='b', s=5, zorder=10)
             
             peaksNb = len(self.indexes)
             self.line1 = "Number of peaks: %3d" %(peaksNb)
             if peaksNb > 1:
-                stripesDist = self.dist_profile[self.indexes[-1]]-self.dist_profile[self.indexes[0]]
+                stripesDist = distPeaks[-1]-distPeaks[0]
                 self.line2 = "Length of stripes: %.5f  (first: %.5f, last: %.5f)" \
-                                %(stripesDist, self.dist_profile[self.indexes[0]], self.dist_profile[self.indexes[-1]])
-                self.line3 = "Growth stripe rate (mm/stripe): %.5f" %(stripesDist/(peaksNb-1))
-                self.ax1.set_title(self.line1 + '\n' + self.line2 + '\n' + self.line3, y=-0.55, loc='left', fontsize=10)
+                                %(stripesDist, distPeaks[0], distPeaks[-1])
+                stripesRate = stripesDist/(peaksNb-1)
+                self.line3 = "Growth stripe rate (mm/stripe): %.5f" %(stripesRate)
+                if np.isfinite(self.spectralRate):
+                    disagree = abs(self.spectralRate - stripesRate) > periodTolerance*stripesRate
+                    line4 = "  (spectral: %.5f%s)" %(self.spectralRate, "  check peaks" if disagree else "")
+                else:
+                    disagree = False
+                    line4 = "  (spectral: no period)"
+                self.ax1.set_title(self.line1 + '\n' + self.line2 + '\n' + self.line3 + line4, y=-0.55, loc='left', fontsize=10,
+                                   color='red' if disagree else 'black')
             else:
                 self.ax1.set_title(self.line1 + '\n\n', y=-0.55, loc='left', fontsize=10)
             
@@ -838,6 +1140,7 @@ class MainWindow(QMainWindow):
                 self.ax1.set_ylim(ylim)
 
             self.labelKernelSize.setEnabled(True)
+            self.comboSmoothing.setEnabled(True)
             self.mySliderKernelSize.setEnabled(True)
             self.labelProfileLinewidth.setEnabled(True)
             self.mySliderProfileLinewidth.setEnabled(True)
@@ -847,10 +1150,18 @@ class MainWindow(QMainWindow):
             self.mySliderPeakUtils_thres.setEnabled(True)
             self.cboxPeaks.setEnabled(True)
             self.cboxReverseProfile.setEnabled(True)
+            self.cboxSubPixelPeaks.setEnabled(True)
+            self.cboxSplineProfile.setEnabled(True)
+            self.comboInterpolation.setEnabled(True)
+            self.comboReduction.setEnabled(True)
+            self.labelPercentile.setEnabled(self.reductionMethod == 'percentile')
+            self.mySliderPercentile.setEnabled(self.reductionMethod == 'percentile')
+            self.buttonSweep.setEnabled(True)
             self.buttonDetectScale.setEnabled(True)
             self.buttonDefineScale.setEnabled(True)
             self.buttonDefineScaleValue.setEnabled(True)
             self.buttonDefineScaleLength.setEnabled(True)
+            self.buttonSaveScalePattern.setEnabled(True)
             self.buttonDefineScale.setEnabled(True)
             self.buttonExtract.setEnabled(True)
 
@@ -860,17 +1171,144 @@ class MainWindow(QMainWindow):
             #print("Error in drawProfile")
             return 
 
+    #------------------------------------------------------------------
+    def sampleProfile(self, xdata, ydata):
+        # Samples are kept in a LRU cache keyed by the geometry (rounded to 0.1 pixel),
+        # the sampling parameters and the image version so that revisited geometries 
+        # and display toggles do not resample the full resolution image. Contrast and 
+        # brightness are applied to the samples, never to a full resolution copy, so that
+        # their changes and the width reduction do not resample either.
+        xdata = np.round(np.asarray(xdata, dtype=float), 1)
+        ydata = np.round(np.asarray(ydata, dtype=float), 1)
+        spline = self.cboxSplineProfile.isChecked()
+        key = (tuple(xdata), tuple(ydata), spline, self.profileLinewidth, self.interpolationOrder, self.imageVersion)
+        if key in self.profileCache:
+            self.profileCache.move_to_end(key)
+            samples, profile_mx, profile_my = self.profileCache[key]
+        else:
+            # all the sub-segments of the polyline (or the whole spline) are sampled in a single call,
+            # image positions of the profile being its centerline
+            if spline:
+                coords = splineCoordinates(xdata, ydata, self.profileLinewidth)
+            else:
+                coords = profileCoordinates(xdata, ydata, self.profileLinewidth)
+            samples = sampleProfileCoordinates(self.image, coords, order=self.interpolationOrder)
+            center = coords[:, (self.profileLinewidth-1)//2] if self.profileLinewidth % 2 else coords.mean(axis=1)
+            profile_my, profile_mx = center
+
+            self.profileCache[key] = (samples, profile_mx, profile_my)
+            while len(self.profileCache) > self.profileCacheSize:
+                self.profileCache.popitem(last=False)
+            self.updateMemory()
+
+        samples = cv2.convertScaleAbs(samples, alpha=self.alphaLevel, beta=self.betaLevel)
+        profile = reduceProfile(samples, self.reductionMethod, self.reductionPercentile)
+        return profile, profile_mx, profile_my
+
+    #------------------------------------------------------------------
+    def memoryBuffers(self):
+        # Large arrays held by the window: image, pyramid, display copies and cached profiles
+        buffers = [('image', getattr(self, 'image', None))]
+        buffers += [('pyramid %d' % level, image) for level, image in enumerate(self.pyramid) if level > 0]
+        buffers += [('imageResized', self.imageResized), ('imageResizedAdjusted', self.imageResizedAdjusted)]
+        buffers += [('profileCache', a) for entry in self.profileCache.values() for a in entry]
+        for fileName, state in self.workspace.items():
+            buffers += [(fileName, image) for image in state['pyramid']]
+            buffers += [(fileName, a) for entry in state['profileCache'].values() for a in entry]
+        return buffers
+
+    #------------------------------------------------------------------
+    def memoryUsed(self):
+        # MB of the distinct buffers
+        return buffersBytes(self.memoryBuffers())[0] / 2.**20
+
+    #------------------------------------------------------------------
+    def updateMemory(self):
+        # Caches and copies evicted in order while the buffers exceed the budget:
+        # least recently used images of the workspace, profiles cache, pyramid copies replaced by views
+        while self.memoryUsed() > self.memoryBudget and len(self.workspace) > 0:
+            fileName, state = self.workspace.popitem(last=False)
+            self.status_bar.showMessage('Memory budget exceeded: %s released' % os.path.basename(fileName), 5000)
+        if self.memoryUsed() > self.memoryBudget and len(self.profileCache) > 0:
+            self.profileCache.clear()
+            self.status_bar.showMessage('Memory budget exceeded: profiles cache cleared', 5000)
+        if self.memoryUsed() > self.memoryBudget and any(level.base is None for level in self.pyramid[1:]):
+            views = [self.image[::2**k, ::2**k] for k in range(len(self.pyramid))]
+            for level, image in enumerate(self.pyramid):
+                if self.imageResized is image:
+                    self.imageResized = views[level]
+            self.pyramid = views
+            self.status_bar.showMessage('Memory budget exceeded: pyramid levels read from the full image', 5000)
+
+        used = self.memoryUsed()
+        self.labelMemory.setText('Memory: %.0f / %d MB' % (used, self.memoryBudget))
+        self.labelMemory.setStyleSheet('color: red' if used > self.memoryBudget else '')
+
+    #------------------------------------------------------------------
+    def defineMemoryBudget(self):
+        budget, ok = QInputDialog.getInt(self, 'Memory budget', 'Budget of the image buffers and caches [MB]:',
+                                         self.memoryBudget, 16, 1024*1024)
+        if not ok: return
+        self.memoryBudget = budget
+        self.updateMemory()
+
+    #------------------------------------------------------------------
+    def peaksOnProfile(self):
+        # Image positions of the peaks interpolated at their (sub-pixel) positions
+        # and projected on the profile line
+        xdata = list(self.line_object.get_xdata())
+        ydata = list(self.line_object.get_ydata())
+        line = LineString(self.profilePath(xdata, ydata))
+        samples = np.arange(len(self.profile_mx))
+        xs = np.interp(self.positions, samples, self.profile_mx)
+        ys = np.interp(self.positions, samples, self.profile_my)
+        # Closest points on the line
+        points = shapely.line_interpolate_point(line, shapely.line_locate_point(line, shapely.points(xs, ys)))
+        points = shapely.get_coordinates(points)
+        return list(points[:,0]), list(points[:,1])
+
+    #------------------------------------------------------------------
+    def sweepPeaksParameters(self):
+        # Number of peaks and stripe rate for all thresholds and minimum distances
+        # computed at once from the smoothed profile, a click selects the parameters
+        thresholds = np.arange(self.mySliderPeakUtils_thres.minimum(), self.mySliderPeakUtils_thres.maximum()+1)
+        minDists = np.arange(self.mySliderPeakUtils_minDist.minimum(), self.mySliderPeakUtils_minDist.maximum()+1)
+        counts, rates = sweepPeaks(self.profile_convolved, self.dist_profile, thresholds, minDists,
+                                   subPixel=self.cboxSubPixelPeaks.isChecked())
+
+        if self.sweepDialog != None:
+            self.sweepDialog.close()
+        self.sweepDialog = SweepDialog(self, thresholds, minDists, counts, rates)
+        self.sweepDialog.show()
+
+    #------------------------------------------------------------------
+    @recorded('selectPeaksParameters')
+    def selectPeaksParameters(self, thres, minDist):
+        # both sliders set without their signals, the profile being redrawn once
+        # (even if the values are unchanged)
+        for slider, value in [(self.mySliderPeakUtils_minDist, minDist), (self.mySliderPeakUtils_thres, thres)]:
+            slider.blockSignals(True)
+            slider.setValue(value)
+            slider.blockSignals(False)
+        self.peakutils_minDist = int(minDist)
+        self.peakutils_thres = int(thres)
+        self.labelPeakUtils_minDist.setText("PeakUtils - Minimum distance: " + str(self.peakutils_minDist))
+        self.labelPeakUtils_thres.setText("PeakUtils - Threshold: %d" % self.peakutils_thres)
+        self.drawProfile(resetAxis=False)
+
     #------------------------------------------------------------------
     def drawTicks(self, line, x, y, length=5):
-        left = line.parallel_offset(length, 'left')
-        right = line.parallel_offset(length, 'right')
-        ticks = []
-        for i in range(len(x)):
-            p = Point(x[i],y[i])
-            a = left.interpolate(line.project(p))
-            b = right.interpolate(line.project(p))
-            ticks.append(LineString([a, p, b]).coords)           # keep p point to sort from distance later
-        return ticks
+        # ticks orthogonal to the line (a polyline) at points x, y, from the local direction of the line
+        p = np.column_stack([x, y]).astype(float)
+        d = shapely.line_locate_point(line, shapely.points(p))
+        delta = min(0.5, line.length/2.)
+        a = shapely.get_coordinates(shapely.line_interpolate_point(line, np.maximum(d - delta, 0.)))
+        b = shapely.get_coordinates(shapely.line_interpolate_point(line, np.minimum(d + delta, line.length)))
+        tangent = b - a
+        tangent /= np.maximum(np.hypot(tangent[:,0], tangent[:,1]), 1e-12)[:,None]
+        normal = np.column_stack([-tangent[:,1], tangent[:,0]]) * length
+        ticks = np.stack([p + normal, p, p - normal], axis=1)         # keep p point to sort from distance later
+        return list(ticks)
 
     #------------------------------------------------------------------
     def openCall(self):
@@ -878,53 +1316,97 @@ class MainWindow(QMainWindow):
 
     #------------------------------------------------------------------
     def detectScale(self):
-        try:
-            mask0 = cv2.inRange(self.imageResized, 0, 0)
-            self.mask = cv2.bitwise_not(mask0)
-            #print("mask: ", self.mask.shape)
-
-            fld = cv2.ximgproc.createFastLineDetector()
-            lines = fld.detect(self.mask)
-            self.scaleLength = 0
-            for line in lines:
-                pt1 = np.array((line[0][0],line[0][1])) * self.subSampling
-                pt2 = np.array((line[0][2],line[0][3])) * self.subSampling
-                length = np.linalg.norm(pt1 - pt2)
-                #print(pt1, pt2, dist)
-                if (length > self.scaleLength):
-                    self.scaleLength = int(length)
-                    point1Scale = pt1
-                    point2Scale = pt2
-            #print("Detected scale length in pixel: ", scaleLength)
-
-            if self.scaleLength > 0:
-                self.removeScale()
-                self.scale_object, = self.ax0.plot([point1Scale[0], point2Scale[0]],
-                                                    [point1Scale[1], point2Scale[1]],
-                                                    alpha=1.0, c='purple', lw=2)
-        except:
-            self.scaleLength = 0
+        # line detection and OCR on the full resolution crop of the scale region only
+        self.scaleValue, self.scaleLength, point1Scale, point2Scale = detectScale(self.image, self.getOCRPool())
+        if self.scaleLength > 0:
+            self.drawScale(point1Scale, point2Scale)
 
-        try:
-            import pytesseract
+        self.storeScale()
+        self.update_image_title()
+        self.drawProfile(resetAxis=True)
 
-            scaleDetected = pytesseract.image_to_string(self.mask)
-            matchObj = re.match(r'[^0-9]*([0-9]*)mm', scaleDetected.strip())
-            self.scaleValue = float(matchObj.group(1))
-            #print("Detected scale value: ", self.scaleValue)
+    #------------------------------------------------------------------
+    def getOCRPool(self):
+        if self.ocrPool is None:
+            self.ocrPool = OCRPool()
+        return self.ocrPool
 
-        except:
-            self.scaleValue = 0.
+    #------------------------------------------------------------------
+    def batchDetectScales(self):
+        # scales of several images detected in parallel and kept in the cache,
+        # restored when the images are opened
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fileNames, _ = QFileDialog.getOpenFileNames(self, "Detect scales of images", 
+                "",
+                "PNG, JPG, TIF Files (*.png *.jpg *.tif);;PNG Files (*.png);;JPG Files (*.jpg);;TIF Files (*.tif);;All Files (*)", 
+                options=options)
+        if not fileNames: return
 
-        self.update_image_title()
-        self.drawProfile(resetAxis=True)
+        self.status_bar.showMessage('Detecting scales of %d images' % len(fileNames))
+        qApp.processEvents()            # Flush events
+
+        results = detectScales(fileNames, self.getOCRPool())
+        detected = 0
+        for result in results:
+            if result['value'] > 0 and result['length'] > 0:
+                self.scaleCache.store(result['hash'], result['file'], result['value'], result['length'],
+                                      result['point1'], result['point2'], save=False)
+                detected += 1
+        self.scaleCache.save()
+        self.status_bar.clearMessage()
+
+        msgBox = QMessageBox(self)
+        msgBox.setText("Scales detected and cached for %d of %d images" % (detected, len(fileNames)))
+        msgBox.setWindowTitle("Scale detection")
+        msgBox.setStandardButtons(QMessageBox.Ok)
+        msgBox.exec()
+
+    #------------------------------------------------------------------
+    def drawScale(self, point1Scale, point2Scale):
+        self.removeScale()
+        self.scalePoints = (point1Scale, point2Scale)
+        self.scale_object, = self.ax0.plot([point1Scale[0], point2Scale[0]],
+                                            [point1Scale[1], point2Scale[1]],
+                                            alpha=1.0, c='purple', lw=2)
 
     #------------------------------------------------------------------
     def removeScale(self):
+        self.scalePoints = None
         if self.scale_object != None:
             self.scale_object.remove()
             self.scale_object = None
 
+    #------------------------------------------------------------------
+    def storeScale(self, pattern=None):
+        # complete scales are kept in the persistent cache by image hash (and filename pattern)
+        if self.scaleValue <= 0 or self.scaleLength <= 0 or self.imageHash is None: return
+        point1Scale, point2Scale = self.scalePoints if self.scalePoints != None else (None, None)
+        self.scaleCache.store(self.imageHash, self.imageFileName, self.scaleValue, self.scaleLength,
+                              point1Scale, point2Scale, pattern)
+
+    #------------------------------------------------------------------
+    def restoreScale(self):
+        entry = self.scaleCache.lookup(self.imageHash, self.imageFileName)
+        if entry is None: return
+        self.scaleValue = entry['value']
+        self.scaleLength = entry['length']
+        if 'points' in entry:
+            self.drawScale(*entry['points'])
+        self.update_image_title()
+        self.status_bar.showMessage('Scale restored from cache', 5000)
+
+    #------------------------------------------------------------------
+    def saveScalePattern(self):
+        # same scale for all the images with filenames matching a pattern,
+        # proposed from the magnification found in the filename
+        matchObj = re.search(r'[0-9]+(\.[0-9]+)?x', os.path.basename(self.imageFileName))
+        default = "*%s*" %matchObj.group(0) if matchObj else os.path.basename(self.imageFileName)
+        pattern, okPressed = QInputDialog.getText(self, "Save scale for file pattern", 
+                                                  "Filename pattern (* and ? wildcards):", QLineEdit.Normal, default)
+        if okPressed and pattern:
+            self.storeScale(pattern)
+
     #------------------------------------------------------------------
     def defineScaleValue(self):
         dialog = QInputDialog()
@@ -943,6 +1425,7 @@ class MainWindow(QMainWindow):
         else:
             return
 
+        self.storeScale()
         self.update_image_title()
         self.drawProfile(resetAxis=True)
         self.update_peaksExtractedPlot(resetAxis=True)
@@ -966,6 +1449,7 @@ class MainWindow(QMainWindow):
             return
 
         self.removeScale()
+        self.storeScale()
         self.update_image_title()
         self.drawProfile(resetAxis=True)
         self.update_peaksExtractedPlot(resetAxis=True)
@@ -977,24 +1461,42 @@ class MainWindow(QMainWindow):
         xdata = self.line_object.get_xdata()
         ydata = self.line_object.get_ydata()
         point1Scale = [xdata[0], ydata[0]]              # Scale from the 1st segment
-        point2Scale = [xdata[1], ydata[1]]
+        point2Scale = [xdata[-1], ydata[-1]]
         self.scaleLength = int(np.linalg.norm(np.array(point1Scale) - np.array(point2Scale)))
         self.update_image_title()
-        self.removeScale()
-        self.scale_object, = self.ax0.plot([point1Scale[0], point2Scale[0]], 
-                                                [point1Scale[1], point2Scale[1]],
-                                                alpha=1.0, c='purple', lw=2)
+        self.drawScale(point1Scale, point2Scale)
+        self.storeScale()
         self.drawProfile(resetAxis=True)
 
+    #------------------------------------------------------------------
+    def profilePath(self, xdata, ydata):
+        # Vertices of the profile path: the control points or the spline through them
+        if self.cboxSplineProfile.isChecked():
+            path = splinePath(xdata, ydata)
+            if path is not None:
+                return np.column_stack(path[:2])
+        return np.column_stack([xdata, ydata])
+
     #------------------------------------------------------------------
     def update_lineWithWidth(self):
         if self.lineWithWidth != None:
             self.lineWithWidth.remove()
             self.lineWithWidth = None
+        if self.curve_object != None:
+            self.curve_object.remove()
+            self.curve_object = None
+        if self.line_object is None: return
+        xdata = list(self.line_object.get_xdata())
+        ydata = list(self.line_object.get_ydata())
+        path = self.profilePath(xdata, ydata)
+        if self.cboxSplineProfile.isChecked() and len(xdata) > 2:
+            # control polygon dotted, spline drawn
+            self.line_object.set_linestyle('dotted')
+            self.curve_object, = self.ax0.plot(path[:,0], path[:,1], alpha=self.alpha_low, c='red', lw=2)
+        else:
+            self.line_object.set_linestyle('solid')
         if self.profileLinewidth > 1:
-            xdata = list(self.line_object.get_xdata())
-            ydata = list(self.line_object.get_ydata())
-            line = LineString([(xdata[0], ydata[0]), (xdata[1], ydata[1])])
+            line = LineString(path)
             dilated = line.buffer(self.profileLinewidth/2., cap_style=2, join_style=1)
             self.lineWithWidth, = self.ax0.plot(*dilated.exterior.xy, alpha=self.alpha_low, c='red', lw=2)
         
@@ -1077,14 +1579,25 @@ class MainWindow(QMainWindow):
         self.status_bar.showMessage('Reading file')
         qApp.processEvents()            # Flush events
 
+        self.storeWorkspace()
+        # the sweep of the previous image must not select the parameters of this one
+        if self.sweepDialog != None:
+            self.sweepDialog.close()
+            self.sweepDialog.deleteLater()
         self.initValues()
         self.initInterface()
 
         self.ax0.set_visible(True)
         self.ax0.clear()
 
+        state = self.workspaceState(self.imageFileName)
+        self.currentFileName = self.imageFileName
+        self.imageMtime = os.path.getmtime(self.imageFileName)
         #print('Reading start')
-        self.image = cv2.imread(self.imageFileName, cv2.IMREAD_GRAYSCALE)
+        if state is None:
+            self.image = cv2.imread(self.imageFileName, cv2.IMREAD_GRAYSCALE)
+        else:
+            self.image = state['image']
         #print('Readind end')
         #print("Shape: ", self.image.shape)
         #print("Width: ", self.image.shape[1])
@@ -1092,10 +1605,15 @@ class MainWindow(QMainWindow):
         self.subSampling = np.ceil(np.max(self.image.shape) / self.imageDisplayedWidthLimit).astype(int)
         self.cur_xlim = [0, self.image.shape[1]]
         self.cur_ylim = [self.image.shape[0], 0]
-        self.update_image_title()
-        self.sampleImage()
-
-        (self.mx, self.my) = np.meshgrid(np.arange(self.image.shape[1]), np.arange(self.image.shape[0]), copy=False)
+        if state is None:
+            self.update_image_title()
+            self.buildPyramid()
+            self.sampleImage()
+            self.updateMemory()
+            self.imageHash = imageHash(self.image)
+            self.restoreScale()
+        else:
+            self.restoreWorkspace(state)
 
         self.cboxInverseImage.setEnabled(True)
         self.labelAlpha.setEnabled(True)
@@ -1105,20 +1623,99 @@ class MainWindow(QMainWindow):
         self.buttonDetectScale.setEnabled(True)
         self.buttonDefineScaleValue.setEnabled(True)
         self.buttonDefineScaleLength.setEnabled(True)
+        self.buttonSaveScalePattern.setEnabled(True)
         self.buttonLoad.setEnabled(True)
+        self.buttonDetectStripes.setEnabled(True)
         self.buttonCapture.setEnabled(True)
         self.buttonSaveFullImage.setEnabled(True)
+        self.buttonSaveFullImagePNG.setEnabled(True)
+        if len(self.segmentList) > 0:
+            self.buttonDeleteLastSegment.setEnabled(True)
+            self.buttonSave.setEnabled(True)
 
         self.status_bar.clearMessage()
 
+    #------------------------------------------------------------------
+    def storeWorkspace(self):
+        # State of the displayed image (image, pyramid, profiles, segments, view and scale)
+        # kept resident to switch back to it without reading the file again
+        if self.currentFileName is None: return
+        self.workspace[self.currentFileName] = {'mtime': self.imageMtime, 'image': self.image, 
+            'pyramid': self.pyramid, 'imageHash': self.imageHash, 'imageVersion': self.imageVersion,
+            'inverse': self.cboxInverseImage.isChecked(), 'profileCache': self.profileCache,
+            'segments': [np.array(p.get_offsets()) for p in self.peaksExtractedList],
+            'xlim': self.cur_xlim, 'ylim': self.cur_ylim, 'subSampling': self.subSampling, 'scaleValue': self.scaleValue,
+            'scaleLength': self.scaleLength, 'scalePoints': self.scalePoints}
+        self.workspace.move_to_end(self.currentFileName)
+        while len(self.workspace) > workspaceSize:
+            self.workspace.popitem(last=False)
+
+    #------------------------------------------------------------------
+    def workspaceState(self, fileName):
+        # Resident state of fileName, dropped if the file has changed since it was read
+        state = self.workspace.pop(fileName, None)
+        if state is None or state['mtime'] != os.path.getmtime(fileName):
+            return None
+        return state
+
+    #------------------------------------------------------------------
+    def restoreWorkspace(self, state):
+        self.pyramid = state['pyramid']
+        self.imageHash = state['imageHash']
+        self.imageVersion = state['imageVersion']
+        self.profileCache = state['profileCache']
+        self.cboxInverseImage.blockSignals(True)
+        self.cboxInverseImage.setChecked(state['inverse'])
+        self.cboxInverseImage.blockSignals(False)
+        self.cur_xlim, self.cur_ylim = state['xlim'], state['ylim']
+        self.subSampling = state['subSampling']
+        self.sampleImage()
+        self.updateMemory()
+
+        self.scaleValue, self.scaleLength = state['scaleValue'], state['scaleLength']
+        if state['scalePoints'] != None:
+            self.drawScale(*state['scalePoints'])
+        self.update_image_title()
+
+        for offsets in state['segments']:
+            self.appendSegmentAndPeaks(list(offsets[:,0]), list(offsets[:,1]))
+        self.update_peaksExtractedPlot(resetAxis=True)
+
+    #------------------------------------------------------------------
+    def updateWorkspaceMenu(self):
+        # resident images, most recently displayed first
+        self.workspaceMenu.clear()
+        for fileName in reversed(self.workspace):
+            action = self.workspaceMenu.addAction(os.path.basename(fileName))
+            action.setStatusTip(fileName)
+            action.triggered.connect(lambda checked, f=fileName: self.switchImage(f))
+
+    #------------------------------------------------------------------
+    def switchImage(self, fileName):
+        self.imageFileName = fileName
+        recorder.record('openImage', [self.imageFileName])
+        self.readImage()
+        self.displayImage()
+
+    #------------------------------------------------------------------
+    def buildPyramid(self):
+        # Levels subsampled by 2 from the previous one (nearest as for display), 
+        # level k pixel (i,j) being the full resolution pixel (i*2**k, j*2**k)
+        self.pyramid = [self.image]
+        while np.max(self.pyramid[-1].shape) > pyramidMinSize:
+            self.pyramid.append(np.ascontiguousarray(self.pyramid[-1][::2, ::2]))
+
     #------------------------------------------------------------------
     def sampleImage(self):
 
         #print("Sampling: ", self.subSampling)
-        if self.subSampling == 1:
-            self.imageResized = self.image
+        # resize from the finest pyramid level coarser than the sampling
+        level = min(int(np.log2(self.subSampling)), len(self.pyramid)-1)
+        factor = self.subSampling / 2**level
+        if factor == 1:
+            self.imageResized = self.pyramid[level]
         else:
-            self.imageResized = cv2.resize(self.image, None, fx=1./self.subSampling, fy=1./self.subSampling, interpolation = cv2.INTER_NEAREST)
+            self.imageResized = cv2.resize(self.pyramid[level], None, fx=1./factor, fy=1./factor, interpolation = cv2.INTER_NEAREST)
         #print("Resized: ", self.imageResized.shape)
 
         if self.text_subSampling != None:
@@ -1128,6 +1725,7 @@ class MainWindow(QMainWindow):
                                                 transform=self.fig.transFigure)
 
     #------------------------------------------------------------------
+    @timed('displayImage')
     def displayImage(self):
 
         ex1 = np.maximum(0, np.min(self.cur_xlim)) 
@@ -1171,9 +1769,19 @@ class MainWindow(QMainWindow):
                 file1NamePNG, "PNG Files (*.png)", options=options)
         if file1NamePNG == "": return
 
-        bbox = self.ax0.get_tightbbox(self.fig.canvas.get_renderer())
-        bbox = Bbox([[0.0, 2.5], [11.0, 8.5]])
-        plt.savefig(file1NamePNG, bbox_inches=bbox)
+        # Copy the region of ax0 (with its labels and texts) from the already rendered
+        # Agg buffer of the canvas, whatever the size of the window (rendered again
+        # only if the figure has changed since its last draw)
+        if self.fig.stale:
+            self.canvas.draw()
+        buffer = np.asarray(self.canvas.buffer_rgba())
+        height, width = buffer.shape[:2]
+        bbox = self.ax0.get_tightbbox(self.canvas.get_renderer())
+        x0 = max(0, int(np.floor(bbox.x0)))
+        x1 = min(width, int(np.ceil(bbox.x1)))
+        y0 = max(0, int(np.floor(height - bbox.y1)))        # display origin is bottom left
+        y1 = min(height, int(np.ceil(height - bbox.y0)))
+        cv2.imwrite(file1NamePNG, cv2.cvtColor(buffer[y0:y1, x0:x1], cv2.COLOR_RGBA2BGRA))
 
         #print("Saved png file: " + file1NamePNG)
         
@@ -1188,48 +1796,120 @@ class MainWindow(QMainWindow):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
         file1NamePNG, _ = QFileDialog.getSaveFileName(self, "Save image with segments and peaks",
-                file1NamePNG, "PNG Files (*.png)", options=options)
+                file1NamePNG, "PNG Files (*.png);;TIFF Files (*.tif *.tiff);;Pyramidal OME-TIFF Files (*.ome.tif)", options=options)
         if file1NamePNG == "": return
 
-        overlay = self.image.copy()
+        self.status_bar.showMessage('Saving image')
+        qApp.processEvents()            # Flush events
+
+        # Overlays are rendered strip by strip so that only a few strips
+        # of the full resolution image are in memory at the same time
+        overlay = self.overlayGeometry()
+        height, width = self.image.shape[:2]
+        strips = (self.renderOverlayStrip(overlay, y, min(y+stripHeight, height))
+                        for y in range(0, height, stripHeight))
+        if file1NamePNG.lower().endswith(('.ome.tif', '.ome.tiff')):
+            self.savePyramidalTIFF(file1NamePNG)
+        elif file1NamePNG.lower().endswith(('.tif', '.tiff')):
+            import tifffile
+
+            with tifffile.TiffWriter(file1NamePNG, bigtiff=self.image.nbytes > 2**32-2**25) as tif:
+                tif.write(self.stripsToTiles(strips, width, 256), shape=(height, width), dtype=self.image.dtype,
+                          tile=(256, 256), compression='zlib', photometric='minisblack')
+        else:
+            writePNG(file1NamePNG, strips, width, height)
 
+        self.status_bar.clearMessage()
+        #print("Saved png file: " + file1NamePNG)
+
+    #------------------------------------------------------------------
+    def savePyramidalTIFF(self, fileName):
+        import tifffile
+
+        # Tiled multi-resolution OME-TIFF built from the display pyramid,
+        # with segments and peaks burned in each level
+        self.defineScalePixel()
+        metadata = {'axes': 'YX'}
+        if self.scalePixel != 1:
+            metadata.update({'PhysicalSizeX': self.scalePixel*1000, 'PhysicalSizeXUnit': 'µm',
+                             'PhysicalSizeY': self.scalePixel*1000, 'PhysicalSizeYUnit': 'µm'})
+        options = dict(tile=(256, 256), compression='zlib', photometric='minisblack')
+        with tifffile.TiffWriter(fileName, bigtiff=True, ome=True) as tif:
+            for level, image in enumerate(self.pyramid):
+                scale = 1. / 2**level
+                overlay = self.overlayGeometry(scale)
+                height, width = image.shape[:2]
+                strips = (self.renderOverlayStrip(overlay, y, min(y+stripHeight, height), image=image, scale=scale)
+                                for y in range(0, height, stripHeight))
+                tiles = self.stripsToTiles(strips, width, 256)
+                if level == 0:
+                    tif.write(tiles, shape=image.shape, dtype=image.dtype, subifds=len(self.pyramid)-1,
+                              metadata=metadata, **options)
+                else:
+                    tif.write(tiles, shape=image.shape, dtype=image.dtype, subfiletype=1, **options)
+
+    #------------------------------------------------------------------
+    def overlayGeometry(self, scale=1.):
+        # Segments, labels and ticks (as a single array) scaled to the output image
+        segments = []
+        for n,segment in enumerate(self.segmentList):
+             xdata = np.asarray(segment.get_xdata(), dtype=float) * scale
+             ydata = np.asarray(segment.get_ydata(), dtype=float) * scale
+             segments.append((np.round(np.column_stack([xdata, ydata])).astype(np.int32), 'S%02d'%(n+1)))
+
+        ticks = []
+        ends = []
+        for ticksCollection in self.ticksCollectionList:
+             segs = ticksCollection.get_segments()
+             for n,t in enumerate(segs):
+                 ticks.append([t[0], t[2]])                 # get bounds of the tick
+                 ends.append(n == 0 or n == len(segs)-1)
+        ticks = np.round(np.array(ticks, dtype=float).reshape(-1, 2, 2) * scale).astype(np.int32)
+
+        return segments, ticks, np.array(ends, dtype=bool)
+
+    #------------------------------------------------------------------
+    def renderOverlayStrip(self, overlay, y0, y1, image=None, scale=1.):
+        if image is None:
+            image = self.image
+        segments, ticks, ends = overlay
         fontFace = cv2.FONT_HERSHEY_SIMPLEX
-        fontSize = 1
+        fontSize = 1 * scale
         fontThickness = 1
-        for n,segment in enumerate(self.segmentList):
-             xdata = list(segment.get_xdata())
-             ydata = list(segment.get_ydata())
-             x0 = round(xdata[0])
-             y0 = round(ydata[0])
-             x1 = round(xdata[1])
-             y1 = round(ydata[1])
-             cv2.line(overlay, pt1=(x0, y0), pt2=(x1, y1), color=(255,0,0),
-                      thickness=1, lineType=cv2.LINE_AA)
-             text = 'S%02d'%(n+1)
+        margin = 2 + round(40 * scale)              # labels and antialiasing overflow
+
+        # drawn on the strip extended by the margin, then cropped, so that lines and labels
+        # are not clipped (antialiased differently) at the strip edges
+        w0, w1 = max(0, y0 - margin), min(image.shape[0], y1 + margin)
+        strip = image[w0:w1].copy()
+        shift = np.array([0, w0], dtype=np.int32)
+        for points, text in segments:
+             if points[:,1].max() < y0 - margin or points[:,1].min() >= y1 + margin:
+                 continue
+             (x0, ys0), (x1, ys1) = points[0], points[-1]
+             cv2.polylines(strip, [points - shift], False, color=(255,0,0),
+                           thickness=1, lineType=cv2.LINE_AA)
              textsize = cv2.getTextSize(text, fontFace, fontSize, fontThickness)[0]
-             offset = (-1 if (y1-y0 >= 0) else 1)*20
-             cv2.putText(overlay, text, (round(x0 - textsize[0]/2) , round(y0 + textsize[1]/2) + offset), 
+             offset = (-1 if (ys1-ys0 >= 0) else 1)*round(20 * scale)
+             cv2.putText(strip, text, (round(x0 - textsize[0]/2) , round(ys0 + textsize[1]/2) + offset - w0), 
                     fontFace, fontSize, (255, 0, 0), fontThickness, cv2.LINE_AA) 
 
-        for ticksCollection in self.ticksCollectionList:
-             ticks = ticksCollection.get_segments()
-             for n,t in enumerate(ticks):
-                 x0 = round(t[0][0])
-                 y0 = round(t[0][1])
-                 x1 = round(t[2][0])        # get bounds of the tick
-                 y1 = round(t[2][1])
-                 if n == 0 or n == len(ticks)-1:
-                     color = (255,255,0)
-                 else:
-                     color = (255,0,0)
-                 cv2.line(overlay, pt1=(x0, y0), pt2=(x1, y1), color=color,
-                       thickness=1, lineType=cv2.LINE_AA)
-
-        # dst = src1*alpha + src2*beta + gamma
-        #alpha = 0.6
-        alpha = 1.0             # no alpha on segments and peaks over the original image
-        image = cv2.addWeighted(overlay, alpha, self.image, 1-alpha, 0)
-        cv2.imwrite(file1NamePNG, image)
+        # only ticks crossing the strip are drawn
+        inside = (ticks[:,:,1].max(axis=1) >= w0 - 2) & (ticks[:,:,1].min(axis=1) < w1 + 2)
+        for t, end in zip(ticks[inside], ends[inside]):
+             color = (255,255,0) if end else (255,0,0)
+             cv2.line(strip, pt1=tuple(t[0] - shift), pt2=tuple(t[1] - shift), color=color,
+                   thickness=1, lineType=cv2.LINE_AA)
+
+        return strip[y0-w0:y1-w0]
+
+    #------------------------------------------------------------------
+    def stripsToTiles(self, strips, width, tileSize):
+        # strips must have a height multiple of tileSize (except the last one)
+        for strip in strips:
+            for y in range(0, strip.shape[0], tileSize):
+                for x in range(0, width, tileSize):
+                    yield strip[y:y+tileSize, x:x+tileSize]
 
     #------------------------------------------------------------------
     def saveFullImageSVG(self):
@@ -1245,63 +1925,48 @@ class MainWindow(QMainWindow):
                 file1NameSVG, "SVG Files (*.svg)", options=options)
         if file1NameSVG == "": return
 
-        with cairo.SVGSurface(file1NameSVG, self.image.shape[1], self.image.shape[0]) as surface:
-             context = cairo.Context(surface)
-             context.set_line_width(1)
-             context.set_source_rgba(0, 0, 1, 1)
-             context.set_font_size(14)
-             context.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        # The svg file is written in a single pass: the image as a reference
+        # then the segments, their labels and their ticks batched as one path per segment
+        height, width = self.image.shape[:2]
+        with open(file1NameSVG, 'w', buffering=2**20) as f:
+             f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+             f.write('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                     'width="%d" height="%d" viewBox="0 0 %d %d">\n' %(width, height, width, height))
+             f.write('<image xlink:href=%s x="0" y="0" width="%d" height="%d"/>\n' 
+                     %(quoteattr("file:///" + self.imageFileName), width, height))
+
+             f.write('<g id="segments" fill="none" stroke="rgb(0,0,255)" stroke-width="1">\n')
+             for n,segment in enumerate(self.segmentList):
+                  xy = np.column_stack([segment.get_xdata(), segment.get_ydata()])
+                  f.write('<path id="S%02d" d="M%s"/>\n' %(n+1, svgCoords(xy, ' L')))
+             f.write('</g>\n')
+
+             f.write('<g id="labels" fill="rgb(0,0,255)" font-family="Arial" font-size="14" '
+                     'text-anchor="middle" dominant-baseline="central">\n')
              for n,segment in enumerate(self.segmentList):
-                  xdata = list(segment.get_xdata())
-                  ydata = list(segment.get_ydata())
-                  x0 = xdata[0]
-                  y0 = ydata[0]
-                  x1 = xdata[1]
-                  y1 = ydata[1]
-                  context.move_to(x0, y0)
-                  context.line_to(x1, y1)
-                  text = 'S%02d'%(n+1)
-                  x_bearing, y_bearing, width, height, x_advance, y_advance = context.text_extents(text)
-                  offset = (-1 if (y1-y0 >= 0) else 1)*20
-                  context.move_to(x0 - (width/2 + x_bearing) , y0 - (height/2 + y_bearing) + offset) 
-                  context.show_text(text)
-                  context.stroke()
-
-             for ticksCollection in self.ticksCollectionList:
+                  xdata = segment.get_xdata()
+                  ydata = segment.get_ydata()
+                  offset = (-1 if (ydata[-1]-ydata[0] >= 0) else 1)*20
+                  f.write('<text x="%.2f" y="%.2f">S%02d</text>\n' %(xdata[0], ydata[0] + offset, n+1))
+             f.write('</g>\n')
+
+             f.write('<g id="ticks" fill="none" stroke-width="1">\n')
+             for n,ticksCollection in enumerate(self.ticksCollectionList):
                   ticks = ticksCollection.get_segments()
-                  for n,t in enumerate(ticks):
-                      x0 = t[0][0]
-                      y0 = t[0][1]
-                      x1 = t[2][0]        # get bounds of the tick
-                      y1 = t[2][1]
-                      if n == 0 or n == len(ticks)-1:
-                          context.set_source_rgba(0, 1, 1, 1)
-                      else:
-                          context.set_source_rgba(0, 0, 1, 1)
-                      context.move_to(x0, y0)
-                      context.line_to(x1, y1)
-                      context.stroke()
-
-        #------- add image xml tag to svg file
-        dom = xml.dom.minidom.parse(file1NameSVG)
-        imageElement = dom.createElement("image")
-        imageElement.setAttribute("xlink:href", "file:///" + self.imageFileName)
-        imageElement.setAttribute("x", "0")
-        imageElement.setAttribute("y", "0")
-        imageElement.setAttribute("width", str(self.image.shape[1]))
-        imageElement.setAttribute("height", str(self.image.shape[0]))
-        node = dom.getElementsByTagName("defs")[0]
-        node.parentNode.insertBefore(imageElement, node)
-        newline = dom.createTextNode('\n')
-        node.parentNode.insertBefore(newline, node)
-        dom.writexml(open(file1NameSVG, 'w+'))
+                  if len(ticks) == 0: continue
+                  bounds = np.array([[t[0], t[2]] for t in ticks], dtype=float)       # get bounds of the ticks
+                  ends = bounds[[0, -1]]
+                  f.write('<path id="TicksS%02d" stroke="rgb(0,0,255)" d="%s"/>\n' %(n+1, svgTicks(bounds[1:-1])))
+                  f.write('<path id="TicksEndsS%02d" stroke="rgb(0,255,255)" d="%s"/>\n' %(n+1, svgTicks(ends)))
+             f.write('</g>\n')
+             f.write('</svg>\n')
 
         #print("Saved svg file: " + file1NameSVG)
 
     #------------------------------------------------------------------
     def appendSegmentAndPeaks(self, x, y):
         self.segmentNumb +=1
-        segment, = self.ax0.plot([x[0], x[-1]], [y[0], y[-1]], c='b', lw=2, alpha=self.alpha_low, zorder=10,
+        segment, = self.ax0.plot(x, y, c='b', lw=2, alpha=self.alpha_low, zorder=10,
                                       label='Segment%02d'%self.segmentNumb)
         self.segmentList.append(segment)
         peaksExtracted = self.ax0.scatter(x, y, c='b', marker='o', s=10, zorder=12, alpha=self.alpha_low,
@@ -1309,7 +1974,7 @@ class MainWindow(QMainWindow):
         self.peaksExtractedList.append(peaksExtracted)
 
         # ticks
-        line = LineString([(x[0], y[0]), (x[-1], y[-1])])
+        line = LineString(list(zip(x, y)))
         ticks = self.drawTicks(line, x, y)
         ticksCollection = LineCollection(ticks, color='b', alpha=self.alpha_low)
         self.ticksCollectionList.append(ticksCollection)
@@ -1323,22 +1988,12 @@ class MainWindow(QMainWindow):
         self.segmentTextList.append(text)
 
     #------------------------------------------------------------------
+    @recorded('extract')
     def extract(self):
         if len(self.indexes) < 2:       # if not at least 2 peaks (cannot draw segment)
             return
 
-        xdata = list(self.line_object.get_xdata())
-        ydata = list(self.line_object.get_ydata())
-        line = LineString([(xdata[0], ydata[0]), (xdata[1], ydata[1])])
-        points = []
-        for i in self.indexes:
-            point = Point(self.profile_mx[i], self.profile_my[i])
-            # Closest point on the line
-            newPoint = line.interpolate(line.project(point))
-            points.append(newPoint)
-
-        line = LineString(points)
-        x, y = line.xy
+        x, y = self.peaksOnProfile()
         self.appendSegmentAndPeaks(x, y)
 
         self.line_object.remove()
@@ -1346,6 +2001,9 @@ class MainWindow(QMainWindow):
         if self.lineWithWidth != None:
             self.lineWithWidth.remove()
             self.lineWithWidth = None
+        if self.curve_object != None:
+            self.curve_object.remove()
+            self.curve_object = None
         if self.peaks != None:
             self.peaks.remove()
             self.peaks = None
@@ -1358,6 +2016,7 @@ class MainWindow(QMainWindow):
         self.update_peaksExtractedPlot(resetAxis=True)
 
         self.labelKernelSize.setEnabled(False)
+        self.comboSmoothing.setEnabled(False)
         self.mySliderKernelSize.setEnabled(False)
         self.labelProfileLinewidth.setEnabled(False)
         self.mySliderProfileLinewidth.setEnabled(False)
@@ -1367,14 +2026,53 @@ class MainWindow(QMainWindow):
         self.mySliderPeakUtils_thres.setEnabled(False)
         self.cboxPeaks.setEnabled(False)
         self.cboxReverseProfile.setEnabled(False)
+        self.cboxSubPixelPeaks.setEnabled(False)
+        self.cboxSplineProfile.setEnabled(False)
+        self.comboInterpolation.setEnabled(False)
+        self.comboReduction.setEnabled(False)
+        self.labelPercentile.setEnabled(False)
+        self.mySliderPercentile.setEnabled(False)
+        self.buttonSweep.setEnabled(False)
+        if self.sweepDialog != None:
+            self.sweepDialog.close()
         self.buttonDetectScale.setEnabled(True)
         self.buttonDefineScaleValue.setEnabled(True)
         self.buttonDefineScaleLength.setEnabled(True)
+        self.buttonSaveScalePattern.setEnabled(True)
         self.buttonDefineScale.setEnabled(False)
 
         self.buttonDeleteLastSegment.setEnabled(True)
         self.buttonSave.setEnabled(True)
 
+    #------------------------------------------------------------------
+    @recorded('detectStripes')
+    def detectStripes(self):
+        # Segments and peaks proposed along the growth axes estimated from the orientation
+        # of the stripes over the whole image, with the current profile parameters,
+        # to be edited as extracted segments
+        if self.line_object != None: return
+
+        self.status_bar.showMessage('Detecting stripes')
+        qApp.processEvents()            # Flush events
+
+        segments = detectStripes(self.image, self.pyramid, tileSize=detectionTileSize,
+                                 alpha=self.alphaLevel, beta=self.betaLevel,
+                                 linewidth=self.profileLinewidth, order=self.interpolationOrder,
+                                 reduction=self.reductionMethod, percentile=self.reductionPercentile,
+                                 kernelSize=self.kernelSize, smoothing=self.smoothingMethod,
+                                 thres=self.peakutils_thres, minDist=self.peakutils_minDist,
+                                 reverse=self.cboxReverseProfile.isChecked(),
+                                 subPixel=self.cboxSubPixelPeaks.isChecked())
+        for x, y in segments:
+            self.appendSegmentAndPeaks(list(x), list(y))
+
+        self.status_bar.showMessage('Detected segments: %d' % len(segments), 5000)
+        if len(segments) == 0: return
+
+        self.update_peaksExtractedPlot(resetAxis=True)
+        self.buttonDeleteLastSegment.setEnabled(True)
+        self.buttonSave.setEnabled(True)
+
     #------------------------------------------------------------------
     def load(self):
         options = QFileDialog.Options()
@@ -1384,7 +2082,11 @@ class MainWindow(QMainWindow):
                 "CSV Files (*.csv);;CSV Files (*.csv)", 
                 options=options)
         if File1NameCSV == "": return
+        self.loadFile(File1NameCSV)
 
+    #------------------------------------------------------------------
+    @recorded('loadFile')
+    def loadFile(self, File1NameCSV):
         try:
             # Read header to get scaleValue and scaleLength
             df1 = pd.read_csv(File1NameCSV, header=None, skiprows=5, nrows=1)
@@ -1444,7 +2146,6 @@ class MainWindow(QMainWindow):
                 file1NameCSV, "CSV Files (*.csv)", options=options)
         if file1NameCSV == "": return
 
-        overlay = self.image.copy()
         date = datetime.datetime.now().strftime("%Y/%m/%d at %X")
 
         file1 = open(file1NameCSV, "w")
@@ -1464,10 +2165,12 @@ class MainWindow(QMainWindow):
         distancePrevious = distanceCumulated = 0
         for s, peaksExtracted in enumerate(self.peaksExtractedList):
             posPeaks = peaksExtracted.get_offsets()
-            x0, y0 = posPeaks[0]
+            # distances along the segment (polyline through its peaks)
+            steps = np.hypot(*np.diff(np.asarray(posPeaks, dtype=float), axis=0).T)
+            distances = self.scalePixel * np.concatenate([[0.], np.cumsum(steps)])
             for i, p in enumerate(posPeaks):
                 x, y = p
-                distance = Point(x0, y0).distance(Point(p)) * self.scalePixel
+                distance = distances[i]
                 if (distance == 0): 
                     stripeLength = 0
                 else:
@@ -1482,6 +2185,7 @@ class MainWindow(QMainWindow):
         #print("Saved csv file: " + file1NameCSV)
         
     #------------------------------------------------------------------
+    @recorded('deleteLastSegment')
     def deleteLastSegment(self):
         self.segmentList[-1].remove()
         self.segmentTextList[-1].remove()
@@ -1513,9 +2217,71 @@ class MainWindow(QMainWindow):
                 "PNG, JPG, TIF Files (*.png *.jpg *.tif);;PNG Files (*.png);;JPG Files (*.jpg);;TIF Files (*.tif);;All Files (*)", 
                 options=options)
         if self.imageFileName:
+            recorder.record('openImage', [self.imageFileName])
             self.readImage()
             self.displayImage()
 
+    #------------------------------------------------------------------
+    def toggled_timings(self, checked):
+        timings.enabled = checked
+        self.labelTimings.setVisible(checked)
+        if checked:
+            timings.clear()
+            self.timerTimings.start(500)
+        else:
+            self.timerTimings.stop()
+
+    #------------------------------------------------------------------
+    def updateTimingsOverlay(self):
+        # frames drawn during the last second and median latencies of the last calls
+        text = "FPS: %.0f" % timings.rate('canvas.draw')
+        for name in ['displayImage', 'drawProfile', 'zoom', 'on_motion', 'canvas.draw']:
+            if name in timings.durations:
+                text += "  %s: %.1f ms" % (name, 1000.*np.median(list(timings.durations[name])[-20:]))
+        self.labelTimings.setText(text)
+
+    #------------------------------------------------------------------
+    def exportTimings(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fileName, _ = QFileDialog.getSaveFileName(self, "Export timings", 
+                "StripesCounter_timings.json", "JSON Files (*.json)", options=options)
+        if fileName == "": return
+        timings.export(fileName)
+
+    #------------------------------------------------------------------
+    def toggled_session(self, checked):
+        if checked:
+            recorder.start(self.width(), self.height())
+            if hasattr(self, 'image'):
+                recorder.record('openImage', [self.imageFileName])
+        else:
+            recorder.stop()
+
+    #------------------------------------------------------------------
+    def saveSession(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fileName, _ = QFileDialog.getSaveFileName(self, "Save recorded session", 
+                "StripesCounter_session.json", "JSON Files (*.json)", options=options)
+        if fileName == "": return
+        recorder.save(fileName)
+
+    #------------------------------------------------------------------
+    def replay(self, fileName):
+        # recorded sessions replayed, slider, combo box and check box changes through their widgets
+        widgets = {'changeValueAlpha': 'mySliderAlpha', 'changeValueBeta': 'mySliderBeta', 
+                   'changeValueKernelSize': 'mySliderKernelSize', 'changeValuePercentile': 'mySliderPercentile',
+                   'changeValueProfileLinewidth': 'mySliderProfileLinewidth', 
+                   'changeValuePeakUtils_minDist': 'mySliderPeakUtils_minDist', 
+                   'changeValuePeakUtils_thres': 'mySliderPeakUtils_thres',
+                   'changeSmoothing': 'comboSmoothing', 'changeInterpolation': 'comboInterpolation',
+                   'changeReduction': 'comboReduction',
+                   'toggled_cboxInverseImage': 'cboxInverseImage', 'toggled_cboxPeaks': 'cboxPeaks',
+                   'toggled_cboxReverseProfile': 'cboxReverseProfile', 
+                   'toggled_cboxSubPixelPeaks': 'cboxSubPixelPeaks', 'toggled_cboxSplineProfile': 'cboxSplineProfile'}
+        replaySession(self, loadSession(fileName), widgets, qApp.processEvents)
+
     #------------------------------------------------------------------
     def exitCall(self):
         self.close()
@@ -1566,6 +2332,25 @@ Developped by Patrick Brockmann (LSCE)
 
 #======================================================
 if __name__ == "__main__":
+    # Replay of a recorded session offscreen, under cProfile:
+    #   python StripesCounter_v12.30.py --replay session.json [--profile stats.prof]
+    if '--replay' in sys.argv:
+        import time, cProfile, pstats
+        os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+        qApp = QApplication(sys.argv)
+        mainWin = MainWindow()
+        sessionFileName = sys.argv[sys.argv.index('--replay')+1]
+        profiler = cProfile.Profile()
+        t0 = time.perf_counter()
+        profiler.enable()
+        mainWin.replay(sessionFileName)
+        profiler.disable()
+        print("Replay of %s: %.3f s" %(sessionFileName, time.perf_counter() - t0))
+        if '--profile' in sys.argv:
+            profiler.dump_stats(sys.argv[sys.argv.index('--profile')+1])
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+        sys.exit(0)
+
     qApp = QApplication(sys.argv)
     mainWin = MainWindow()
     mainWin.show()
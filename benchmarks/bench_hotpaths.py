@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+#=================================================================
+# Benchmark of the interactive hot paths of StripesCounter
+#=================================================================
+
+# Usage: python benchmarks/bench_hotpaths.py [--sizes 5000 10000 25000] [--segments 10 100] [--repeat 3]
+# Drives a MainWindow headlessly (offscreen Qt platform) on synthetic images and
+# sessions of N segments, and reports for each operation the best wall time and
+# the peak memory traced by tracemalloc (Python and numpy allocations) during one
+# call, with the maximum resident size of the process after it.
+
+#------------------------------------------------------------------
+import sys, os, time, argparse, tempfile, tracemalloc, resource, importlib.util
+import numpy as np
+import cv2
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+
+from PyQt5.QtWidgets import QApplication, QFileDialog
+app = QApplication.instance() or QApplication([])
+
+spec = importlib.util.spec_from_file_location('StripesCounter', os.path.join(root, 'StripesCounter_v12.30.py'))
+StripesCounter = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(StripesCounter)
+StripesCounter.qApp = app
+
+#------------------------------------------------------------------
+def syntheticImage(fileName, size, rng):
+    # stripes of varying period along the rows, a noise by column and a black scale bar
+    y = np.arange(size)
+    period = 12 + 4*np.sin(2*np.pi*y/max(size/3, 1))
+    rows = (90 + 60*(1 + np.sin(2*np.pi*np.cumsum(1./period)))/2).astype(np.uint8)
+    cols = rng.integers(0, 20, size, dtype=np.uint8)
+    image = rows[:,None] + cols[None,:]
+    image[size//10:size//10+size//5, size//50:size//50+2] = 0
+    cv2.imwrite(fileName, image)
+
+#------------------------------------------------------------------
+class Event:
+    pass
+
+def mouseEvent(window, x, y, button=1, key=None, dblclick=False):
+    event = Event()
+    event.button, event.key, event.dblclick = button, key, dblclick
+    event.inaxes, event.canvas = window.ax0, window.canvas
+    event.xdata, event.ydata = x, y
+    event.x, event.y = window.ax0.transData.transform((x, y))
+    return event
+
+def addProfile(window, points):
+    for x, y in points:
+        event = mouseEvent(window, x, y, key='shift', dblclick=True)
+        window.on_press(event)
+        window.on_release(event)
+
+def addSegments(window, size, segments, rng, peaks=50):
+    for s in range(segments):
+        x0, y0 = rng.uniform(0.1*size, 0.9*size, 2)
+        angle = rng.uniform(0, np.pi)
+        step = rng.uniform(5, 20)
+        t = np.arange(peaks) * step
+        window.appendSegmentAndPeaks(list(x0 + t*np.cos(angle)), list(y0 + t*np.sin(angle)))
+
+def clearSegments(window):
+    while len(window.segmentList) > 0:
+        window.deleteLastSegment()
+
+#------------------------------------------------------------------
+def measure(func, repeat, setup=None):
+    # best wall time of repeat calls, then peak traced memory of one more call,
+    # setup being called (not measured) before each call
+    best = np.inf
+    for i in range(repeat):
+        if setup: setup()
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    if setup: setup()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.     # kB on Linux
+    return best, peak / 2.**20, maxRSS
+
+def report(size, segments, operation, result):
+    print("%7d %9s %-28s %10.4f %14.1f %12.1f" %((size, segments, operation) + result), flush=True)
+
+#------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark StripesCounter hot paths")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 10000, 25000])
+    parser.add_argument('--segments', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    directory = tempfile.mkdtemp()
+    fileNameCSV = os.path.join(directory, 'session.csv')
+    QFileDialog.getSaveFileName = staticmethod(lambda *a, **k: (fileNameCSV, ''))
+    QFileDialog.getOpenFileName = staticmethod(lambda *a, **k: (fileNameCSV, ''))
+
+    print("%7s %9s %-28s %10s %14s %12s" %("Size", "Segments", "Operation", "Time[s]", "Traced peak[MB]", "Max RSS[MB]"))
+    for size in args.sizes:
+        fileName = os.path.join(directory, 'synthetic_%d.png' % size)
+        syntheticImage(fileName, size, rng)
+
+        window = StripesCounter.MainWindow()
+        window.resize(1400, 900)
+        window.imageFileName = fileName
+        # reading measured without the images kept resident by the workspace
+        def releaseImages():
+            window.workspace.clear()
+            window.currentFileName = None
+        report(size, '-', 'readImage', measure(window.readImage, args.repeat, setup=releaseImages))
+        report(size, '-', 'readImage (resident)', measure(window.readImage, args.repeat))
+        report(size, '-', 'sampleImage', measure(window.sampleImage, args.repeat))
+        report(size, '-', 'displayImage', measure(window.displayImage, args.repeat))
+
+        addProfile(window, [(0.3*size, 0.1*size), (0.35*size, 0.9*size)])
+        # sampling measured without the cache of profiles
+        report(size, '-', 'drawProfile', measure(lambda: window.drawProfile(resetAxis=True), args.repeat,
+                                                 setup=window.profileCache.clear))
+        report(size, '-', 'drawProfile (cached)', measure(lambda: window.drawProfile(resetAxis=True), args.repeat))
+        window.extract()
+
+        for segments in args.segments:
+            clearSegments(window)
+            addSegments(window, size, segments, rng)
+            report(size, segments, 'update_peaksExtractedPlot', measure(window.update_peaksExtractedPlot, args.repeat))
+            report(size, segments, 'save', measure(window.save, args.repeat))
+            report(size, segments, 'load', measure(window.load, args.repeat, setup=lambda: clearSegments(window)))
+
+        window.close()
+        os.remove(fileName)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+#=================================================================
+# Benchmark of peaks detection: peakutils.indexes versus stripes_profile.findPeaks
+#=================================================================
+
+# Usage: python benchmarks/bench_peaks.py [--sizes 1000 10000 ...] [--repeat 3]
+# Compares speed and output on profiles extracted from the sample BEL17 images
+# and on synthetic profiles of 10^3 to 10^7 samples. peakutils leaves the order of
+# peaks of equal heights arbitrary (findPeaks prefers the leftmost), so outputs are
+# compared to the peakutils selection with the leftmost peaks preferred for ties.
+
+#------------------------------------------------------------------
+import sys, os, glob, time, argparse
+import numpy as np
+import cv2
+import peakutils
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+from stripes_profile import findPeaks
+
+#------------------------------------------------------------------
+def smooth(profile, kernelSize=3):
+    # same smoothing as drawProfile (box kernel with nan boundaries)
+    kernel = np.ones(kernelSize) / kernelSize
+    kernelOffset = int(kernelSize/2)
+    profile_convolved = np.convolve(profile, kernel, mode='same')
+    profile_convolved[0:kernelOffset] = profile_convolved[-kernelOffset:] = np.nan
+    return profile_convolved
+
+#------------------------------------------------------------------
+def imageProfiles():
+    # longest horizontal, vertical and diagonal profiles of each sample image
+    for fileName in sorted(glob.glob(os.path.join(root, 'BEL17*.png'))):
+        image = cv2.imread(fileName, cv2.IMREAD_GRAYSCALE).astype(float)
+        h, w = image.shape
+        n = min(h, w)
+        yield os.path.basename(fileName) + ' row', smooth(image[h//2])
+        yield os.path.basename(fileName) + ' column', smooth(image[:, w//2])
+        yield os.path.basename(fileName) + ' diagonal', smooth(image[np.arange(n), np.arange(n)])
+
+#------------------------------------------------------------------
+def syntheticProfile(size, rng):
+    # stripes of varying period with noise and a trend, quantized as 8 bits pixels
+    x = np.arange(size)
+    period = 8 + 4*np.sin(2*np.pi*x/max(size/5, 1))
+    profile = 125 + 40*np.sin(2*np.pi*np.cumsum(1./period)) + 20*x/size + rng.normal(0, 8, size)
+    return smooth(np.clip(np.round(profile), 0, 255))
+
+#------------------------------------------------------------------
+def referencePeaks(y, thres, minDist):
+    # peakutils.indexes with the leftmost peaks preferred among peaks of equal heights:
+    # peaks of peakutils without selection, then its selection by minimum distance
+    peaks = peakutils.indexes(y, thres=thres, thres_abs=True, min_dist=1)
+    if peaks.size > 1 and minDist > 1:
+        highest = peaks[np.lexsort((peaks, -y[peaks]))]
+        rem = np.ones(y.size, dtype=bool)
+        rem[peaks] = False
+        for peak in highest:
+            if not rem[peak]:
+                rem[max(0, peak - minDist):peak + minDist + 1] = True
+                rem[peak] = False
+        peaks = np.arange(y.size)[~rem]
+    return peaks
+
+#------------------------------------------------------------------
+def timeit(func, repeat):
+    best = np.inf
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+#------------------------------------------------------------------
+def compare(name, profile, thres, minDist, repeat):
+    tPeakutils, ref = timeit(lambda: peakutils.indexes(profile, thres=thres, thres_abs=True, min_dist=minDist), repeat)
+    tNative, res = timeit(lambda: findPeaks(profile, thres=thres, min_dist=minDist), repeat)
+    same = np.array_equal(referencePeaks(profile, thres, minDist), res)
+    print("%-45s %9d %7d %8d %12.5f %12.5f %8.1f %6s" %(name, len(profile), minDist, len(ref),
+                tPeakutils, tNative, tPeakutils/max(tNative, 1e-9), same))
+    return same
+
+#------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark peakutils.indexes versus findPeaks")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**3, 10**4, 10**5, 10**6, 10**7])
+    parser.add_argument('--minDist', type=int, nargs='+', default=[1, 5, 15])
+    parser.add_argument('--thres', type=float, default=125)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("%-45s %9s %7s %8s %12s %12s %8s %6s" %("Profile", "Samples", "minDist", "Peaks",
+                "peakutils[s]", "findPeaks[s]", "Speedup", "Same"))
+    allSame = True
+    for name, profile in imageProfiles():
+        for minDist in args.minDist:
+            allSame &= compare(name, profile, args.thres, minDist, args.repeat)
+
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        profile = syntheticProfile(size, rng)
+        for minDist in args.minDist:
+            allSame &= compare("synthetic", profile, args.thres, minDist, args.repeat)
+
+    sys.exit(0 if allSame else 1)
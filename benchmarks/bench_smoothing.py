@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+#=================================================================
+# Benchmark of the smoothing methods of stripes_profile.smoothProfile
+#=================================================================
+
+# Usage: python benchmarks/bench_smoothing.py [--sizes 100000 ...] [--kernels 3 51 ...]
+# Reports timings on long synthetic profiles, with np.convolve (the former
+# box smoothing of drawProfile) as a reference.
+
+#------------------------------------------------------------------
+import sys, os, time, argparse
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+from stripes_profile import smoothProfile, smoothingMethods
+
+#------------------------------------------------------------------
+def timeit(func, repeat):
+    best = np.inf
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+#------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark smoothing methods")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**5, 10**6, 10**7])
+    parser.add_argument('--kernels', type=int, nargs='+', default=[3, 11, 51, 201])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    methods = list(smoothingMethods)
+    print("%9s %7s %14s" %("Samples", "Kernel", "np.convolve[s]") + "".join(" %14s" %(m + "[s]") for m in methods))
+    for size in args.sizes:
+        profile = np.round(rng.uniform(0, 255, size))
+        for kernelSize in args.kernels:
+            kernel = np.ones(kernelSize) / kernelSize
+            line = "%9d %7d %14.5f" %(size, kernelSize, timeit(lambda: np.convolve(profile, kernel, mode='same'), args.repeat))
+            for method in methods:
+                line += " %14.5f" %timeit(lambda: smoothProfile(profile, kernelSize, method), args.repeat)
+            print(line)
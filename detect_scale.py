@@ -4,53 +4,45 @@
 # Author: Patrick Brockmann CEA/DRF/LSCE - Feb 2021
 #=================================================================
 
-# Test detection of the scale
-# Usage: ./detect_scale.py BEL17-2-2_1.35x_haut0001.png
+# Detection of the scale of images (line detection and OCR on the scale region)
+# Usage: ./detect_scale.py [--workers 8] [--csv scales.csv] [--cache] BEL17-2-2_1.35x_haut0001.png ...
+# OCR workers are kept for the whole batch: tesseract API instances when tesserocr
+# is installed, else one tesseract process per batch of images.
 
 #------------------------------------------------------------------
-import sys, re, os
-import numpy as np
-import cv2
-import pytesseract
+import sys, argparse
+import pandas as pd
 
-#------------------------------------------------------------------
-imageFileName = sys.argv[1]
-print("File: ", imageFileName)
-
-#------------------------------------------------------------------
-img = cv2.imread(imageFileName)
-gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-mask = cv2.inRange(gray, 0, 0)
-
-print("Writing mask.png")
-cv2.imwrite('mask.png', mask)
-
-# https://github.com/tesseract-ocr/tesseract/issues/1913
-maskinv= cv2.bitwise_not(mask)
-cv2.imwrite('maskinv.png', maskinv)
-
-#------------------------------------------------------------------
-try:
-    scaleDetected = pytesseract.image_to_string(maskinv)
-    matchObj = re.match(r'[^0-9]*([0-9]*)mm', scaleDetected.strip())
-    scaleValue = float(matchObj.group(1))
-    print("Detected scale value: ", scaleValue)
-except:
-    print("Detected scale value: not possible")
+from stripes_scale import detectScales, OCRPool, ScaleCache
 
 #------------------------------------------------------------------
-try:
-    fld = cv2.ximgproc.createFastLineDetector()
-    lines = fld.detect(mask)
-    scaleLength = 0
-    for line in lines:
-        point1 = np.array((line[0][0],line[0][1]))
-        point2 = np.array((line[0][2],line[0][3]))
-        length = np.linalg.norm(point1 - point2)
-        #print(point1, point2, dist)
-        if (length > scaleLength):
-            scaleLength = int(length) 
-    print("Detected scale length in pixel: ", scaleLength)
-except:
-    print("Detected scale length in pixel: not possible")
-    
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect the scale value and length of images")
+    parser.add_argument('files', nargs='+', help="image files")
+    parser.add_argument('--workers', type=int, default=None, help="number of parallel workers (default: number of CPUs)")
+    parser.add_argument('--csv', default=None, help="save the detected scales in a CSV file")
+    parser.add_argument('--cache', action='store_true', help="store the detected scales in the StripesCounter scale cache")
+    args = parser.parse_args()
+
+    ocr = OCRPool(args.workers)
+    results = detectScales(args.files, ocr, args.workers)
+    ocr.close()
+
+    for result in results:
+        print("File: ", result['file'])
+        print("Detected scale value: ", result['value'] if result['value'] > 0 else "not possible")
+        print("Detected scale length in pixel: ", result['length'] if result['length'] > 0 else "not possible")
+
+    if args.csv:
+        df = pd.DataFrame([{'file': r['file'], 'scaleValue': r['value'], 'scaleLength': r['length']} for r in results])
+        df.to_csv(args.csv, index=False)
+
+    if args.cache:
+        cache = ScaleCache()
+        for result in results:
+            if result['value'] > 0 and result['length'] > 0:
+                cache.store(result['hash'], result['file'], result['value'], result['length'],
+                            result['point1'], result['point2'], save=False)
+        cache.save()
+
+    sys.exit(0 if all(r['value'] > 0 and r['length'] > 0 for r in results) else 1)
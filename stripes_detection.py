@@ -0,0 +1,94 @@
+
+#=================================================================
+# Automatic stripes detection over the whole image used by StripesCounter
+#=================================================================
+
+import os
+import numpy as np
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+from stripes_profile import profileCoordinates, sampleProfileCoordinates, reduceProfile
+from stripes_profile import smoothProfile, findPeaks, refinePeaks
+
+#------------------------------------------------------------------
+def orientationField(image, tileSize, sigma=2.):
+    # Mean structure tensor of each tile of tileSize pixels of image, as the
+    # orientation (radians) of the dominant gradient (across the stripes, i.e. along
+    # the growth axis), the coherence (0: isotropic, 1: single orientation) and
+    # the energy (trace of the tensor) of shape (tiles rows, tiles cols).
+    image = cv2.GaussianBlur(image.astype(np.float32), (0, 0), 1.)
+    gx = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=3)
+    jxx = cv2.GaussianBlur(gx*gx, (0, 0), sigma)
+    jyy = cv2.GaussianBlur(gy*gy, (0, 0), sigma)
+    jxy = cv2.GaussianBlur(gx*gy, (0, 0), sigma)
+
+    # means over the tiles (partial tiles on the right and bottom boundaries are dropped)
+    ny, nx = image.shape[0] // tileSize, image.shape[1] // tileSize
+    def tiles(j):
+        return j[:ny*tileSize, :nx*tileSize].reshape(ny, tileSize, nx, tileSize).mean(axis=(1, 3))
+    jxx, jyy, jxy = tiles(jxx), tiles(jyy), tiles(jxy)
+
+    orientation = 0.5 * np.arctan2(2*jxy, jxx - jyy)
+    energy = jxx + jyy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coherence = np.where(energy > 0, np.hypot(jxx - jyy, 2*jxy) / energy, 0.)
+    return orientation, coherence, energy
+
+#------------------------------------------------------------------
+def candidateAxes(pyramid, tileSize=512, maxSize=2048, minCoherence=0.3, maxAxes=20):
+    # Growth axes proposed from the orientation field computed on the finest pyramid
+    # level not larger than maxSize: one axis of tileSize (full resolution) pixels
+    # centered on each tile, along its dominant gradient, for the most coherent tiles
+    # with an energy above the median. Returns a list of ([x0, x1], [y0, y1]).
+    level = next((k for k, p in enumerate(pyramid) if np.max(p.shape) <= maxSize), len(pyramid)-1)
+    factor = 2**level
+    levelTileSize = max(tileSize // factor, 8)
+    orientation, coherence, energy = orientationField(pyramid[level], levelTileSize)
+    if coherence.size == 0:
+        return []
+
+    valid = (coherence >= minCoherence) & (energy > np.median(energy))
+    rows, cols = np.nonzero(valid)
+    order = np.argsort(-coherence[rows, cols], kind='stable')[:maxAxes]
+    rows, cols = rows[order], cols[order]
+
+    height, width = pyramid[0].shape[:2]
+    cx = (cols + 0.5) * levelTileSize * factor
+    cy = (rows + 0.5) * levelTileSize * factor
+    dx = np.cos(orientation[rows, cols]) * tileSize / 2.
+    dy = np.sin(orientation[rows, cols]) * tileSize / 2.
+    x0, x1 = np.clip(cx - dx, 0, width-1), np.clip(cx + dx, 0, width-1)
+    y0, y1 = np.clip(cy - dy, 0, height-1), np.clip(cy + dy, 0, height-1)
+    return [([x0[i], x1[i]], [y0[i], y1[i]]) for i in range(len(rows))]
+
+#------------------------------------------------------------------
+def axisPeaks(image, xdata, ydata, linewidth=1, order=0, reduction='mean', percentile=50, alpha=1., beta=0,
+              kernelSize=3, smoothing='box', thres=125, minDist=1, reverse=False, subPixel=True):
+    # Image positions of the peaks of the profile along the polyline xdata, ydata,
+    # computed as drawProfile does for a hand drawn profile (contrast alpha and
+    # brightness beta applied to the samples)
+    coords = profileCoordinates(xdata, ydata, linewidth)
+    samples = cv2.convertScaleAbs(sampleProfileCoordinates(image, coords, order), alpha=alpha, beta=beta)
+    profile = reduceProfile(samples, reduction, percentile)
+    if reverse:
+        profile = 255 - profile
+    smoothed = smoothProfile(profile, kernelSize, smoothing)
+    indexes = findPeaks(smoothed, thres=thres, min_dist=minDist)
+    positions = refinePeaks(smoothed, indexes) if subPixel else indexes.astype(float)
+    center = coords[:, (linewidth-1)//2] if linewidth % 2 else coords.mean(axis=1)
+    samples = np.arange(coords.shape[2])
+    return np.interp(positions, samples, center[1]), np.interp(positions, samples, center[0])
+
+#------------------------------------------------------------------
+def detectStripes(image, pyramid, tileSize=512, minPeaks=3, workers=None, **parameters):
+    # Peaks along the candidate growth axes of the whole image, the axes being processed
+    # in parallel (cv2 and numpy release the GIL). Returns a list of (x, y) peaks
+    # positions with at least minPeaks peaks, the parameters being those of axisPeaks.
+    axes = candidateAxes(pyramid, tileSize)
+    if len(axes) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = list(executor.map(lambda axis: axisPeaks(image, axis[0], axis[1], **parameters), axes))
+    return [(x, y) for x, y in results if len(x) >= minPeaks]
@@ -0,0 +1,30 @@
+
+#=================================================================
+# Memory accounting of the large buffers of StripesCounter
+#=================================================================
+
+import numpy as np
+
+#------------------------------------------------------------------
+def owner(array):
+    # Array owning the memory of array (views of a same array share their owner)
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+#------------------------------------------------------------------
+def buffersBytes(buffers):
+    # Total bytes of the arrays of buffers (name, array), the memory shared by
+    # views being counted once, and the bytes of each buffer as (name, bytes)
+    # in decreasing order (0 for the views of an already counted buffer)
+    counted = set()
+    sizes = []
+    for name, array in buffers:
+        if array is None:
+            continue
+        array = owner(np.asarray(array))
+        size = 0 if id(array) in counted else array.nbytes
+        counted.add(id(array))
+        sizes.append((name, size))
+    sizes.sort(key=lambda s: -s[1])
+    return sum(size for name, size in sizes), sizes
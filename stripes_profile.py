@@ -0,0 +1,326 @@
+
+#=================================================================
+# Profile processing used by StripesCounter
+#=================================================================
+
+import numpy as np
+import cv2
+from scipy.signal import find_peaks, fftconvolve, savgol_filter
+from scipy.ndimage import median_filter, map_coordinates
+from scipy.interpolate import CubicSpline
+
+#------------------------------------------------------------------
+def refinePeaks(y, indexes, method='parabolic'):
+    # Sub-sample positions of peaks from a parabola fitted, for all peaks at once,
+    # on each peak and its 2 neighbours (on the log of the values for 'gaussian').
+    # Peaks on the boundaries or with undefined neighbours are kept unchanged.
+    y = np.asarray(y, dtype=float)
+    indexes = np.asarray(indexes, dtype=int)
+    positions = indexes.astype(float)
+
+    inner = (indexes > 0) & (indexes < len(y)-1)
+    i = indexes[inner]
+    left, center, right = y[i-1], y[i], y[i+1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'gaussian':
+            left, center, right = np.log(left), np.log(center), np.log(right)
+        denominator = left - 2*center + right
+        delta = 0.5 * (left - right) / denominator
+    valid = np.isfinite(delta) & (denominator < 0)
+    positions[inner] += np.where(valid, np.clip(delta, -0.5, 0.5), 0.)
+
+    return positions
+
+#------------------------------------------------------------------
+def findPeaks(y, thres, min_dist=1):
+    # Same peaks as peakutils.indexes(y, thres=thres, thres_abs=True, min_dist=min_dist):
+    # maxima from the first order difference where plateaus take the slope of their
+    # left neighbour on their left half and of their right neighbour on their right half,
+    # higher than thres, then the highest peaks are preferred to satisfy min_dist.
+    # Plateaus are handled with array operations and the minimum distance selection
+    # is done by scipy (same priority order, distance strictly greater than min_dist).
+    # Peaks of equal heights, left in an arbitrary order by peakutils, are preferred
+    # from the left so that the selection does not depend on the other peaks.
+    y = np.asarray(y, dtype=float)
+    min_dist = int(min_dist)
+
+    dy = np.diff(y)
+    zeros = (dy == 0)
+    if zeros.all():                         # totally flat signal
+        return np.array([], dtype=np.int64)
+
+    if zeros.any():
+        # chains of zeros (plateaus) as [starts, ends]
+        edges = np.diff(np.concatenate([[0], zeros.view(np.int8), [0]]))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1) - 1
+        chain = np.repeat(np.arange(len(starts)), ends - starts + 1)
+        position = np.flatnonzero(zeros)
+        left = dy[np.maximum(starts - 1, 0)][chain]
+        right = dy[np.minimum(ends + 1, len(dy) - 1)][chain]
+        useRight = position >= (starts + ends)[chain] / 2.
+        useRight[starts[chain] == 0] = True                    # leftmost values of dy are zero
+        useRight[ends[chain] == len(dy) - 1] = False           # rightmost values of dy are zero
+        dy[position] = np.where(useRight, right, left)
+
+    peaks = np.flatnonzero((np.concatenate([dy, [0.]]) < 0.) & 
+                           (np.concatenate([[0.], dy]) > 0.) & 
+                           (y > thres))
+
+    if peaks.size > 1 and min_dist > 1:
+        # peaks are isolated maxima of this signal, so find_peaks keeps them all
+        # before its selection by distance, done by their ranks
+        isolated = np.full(y.size, -np.inf)
+        isolated[peaks] = peakRanks(y, peaks)
+        peaks, _ = find_peaks(isolated, distance=min_dist + 1)
+
+    return peaks.astype(np.int64)
+
+def peakRanks(y, peaks):
+    # Ranks (1 for the lowest) of the peaks by height, the leftmost first for equal heights
+    ranks = np.empty(len(peaks))
+    ranks[np.lexsort((-peaks, y[peaks]))] = np.arange(1, len(peaks) + 1)
+    return ranks
+
+#------------------------------------------------------------------
+smoothingMethods = {'box': 'Box', 'gaussian': 'Gaussian', 'savgol': 'Savitzky-Golay', 'median': 'Median'}
+
+#------------------------------------------------------------------
+def smoothProfile(y, kernelSize, method='box'):
+    # Smoothed profile of same length with the kernelSize/2 boundary values put to nan.
+    #   box: moving average, from the cumulative sum (O(n) whatever the kernel size) for large kernels
+    #   gaussian: kernel of sigma kernelSize/6, convolved by FFT for large kernels
+    #   savgol: Savitzky-Golay filter of polynomial order 2
+    #   median: moving median
+    y = np.asarray(y, dtype=float)
+    kernelSize = int(kernelSize)
+    kernelOffset = int(kernelSize/2)
+    if kernelSize <= 1 or len(y) < kernelSize:
+        smoothed = y.copy()
+    elif method == 'box' and kernelSize <= 15:
+        smoothed = np.convolve(y, np.ones(kernelSize) / kernelSize, mode='same')
+    elif method == 'box':
+        cumsum = np.concatenate([[0.], np.cumsum(y)])
+        smoothed = np.empty_like(y)
+        start = kernelOffset
+        smoothed[start:start+len(y)-kernelSize+1] = (cumsum[kernelSize:] - cumsum[:-kernelSize]) / kernelSize
+    elif method == 'gaussian':
+        x = np.arange(kernelSize) - (kernelSize-1)/2.
+        kernel = np.exp(-0.5 * (x / (kernelSize/6.))**2)
+        kernel /= kernel.sum()
+        if kernelSize > 500:
+            smoothed = fftconvolve(y, kernel, mode='same')
+        else:
+            smoothed = np.convolve(y, kernel, mode='same')
+    elif method == 'savgol':
+        smoothed = savgol_filter(y, kernelSize, min(2, kernelSize-1), mode='constant')
+    elif method == 'median':
+        smoothed = median_filter(y, size=kernelSize, mode='constant')
+    else:
+        raise ValueError("Unknown smoothing method: %s" % method)
+
+    if kernelOffset > 0:
+        smoothed[:kernelOffset] = smoothed[len(y)-kernelOffset:] = np.nan
+    return smoothed
+
+#------------------------------------------------------------------
+def sweepPeaks(y, dist, thresholds, minDists, subPixel=False):
+    # Number of peaks and stripe rate (distance between first and last peaks / (number-1))
+    # for all combinations of thresholds and minimum distances, as arrays of shape
+    # (len(minDists), len(thresholds)), peaks being at their sub-sample positions if subPixel.
+    # Higher peaks (the leftmost for equal heights) are selected first by the minimum
+    # distance, so peaks lower than a threshold never change the selection of the higher
+    # ones: peaks are detected once without threshold for each minimum distance and
+    # thresholded all at once, giving the same peaks as findPeaks.
+    y = np.asarray(y, dtype=float)
+    dist = np.asarray(dist, dtype=float)
+    thresholds = np.asarray(thresholds, dtype=float)
+    counts = np.zeros((len(minDists), len(thresholds)), dtype=int)
+    rates = np.full((len(minDists), len(thresholds)), np.nan)
+    for j, minDist in enumerate(minDists):
+        peaks = findPeaks(y, -np.inf, minDist)
+        if len(peaks) == 0: continue
+        positions = refinePeaks(y, peaks) if subPixel else peaks.astype(float)
+        distPeaks = np.interp(positions, np.arange(len(y)), dist)
+        above = y[peaks][None,:] > thresholds[:,None]
+        counts[j] = above.sum(axis=1)
+        first = np.argmax(above, axis=1)
+        last = len(peaks) - 1 - np.argmax(above[:,::-1], axis=1)
+        valid = counts[j] > 1
+        rates[j, valid] = (distPeaks[last[valid]] - distPeaks[first[valid]]) / (counts[j, valid] - 1)
+    return counts, rates
+
+#------------------------------------------------------------------
+def profileCoordinates(xdata, ydata, linewidth=1):
+    # Sampling coordinates of a polyline profile for all its sub-segments at once,
+    # as (rows, cols) of shape (2, linewidth, length). Each sub-segment is sampled 
+    # as skimage profile_line does (ceil(length)+1 samples, here without repeating 
+    # the vertex shared with the previous sub-segment) with lines of linewidth 
+    # samples perpendicular to the sub-segment.
+    xdata = np.asarray(xdata, dtype=float)
+    ydata = np.asarray(ydata, dtype=float)
+    d_col = np.diff(xdata)
+    d_row = np.diff(ydata)
+    length = np.hypot(d_row, d_col)
+    counts = np.ceil(length + 1).astype(int)
+    counts[1:] -= 1                                     # shared vertices
+
+    segment = np.repeat(np.arange(len(counts)), counts)
+    step = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    step[np.repeat(np.arange(len(counts)) > 0, counts)] += 1
+    t = step / np.maximum(np.ceil(length + 1) - 1, 1)[segment]
+    rows = ydata[segment] + t * d_row[segment]
+    cols = xdata[segment] + t * d_col[segment]
+
+    # unit normals of the sub-segments
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normal_row = np.where(length > 0, d_col / length, 0.)[segment]
+        normal_col = np.where(length > 0, -d_row / length, 0.)[segment]
+    offsets = np.linspace(-(linewidth-1)/2., (linewidth-1)/2., linewidth)[:,None]
+    return np.stack([rows[None,:] + offsets * normal_row[None,:], 
+                     cols[None,:] + offsets * normal_col[None,:]])
+
+#------------------------------------------------------------------
+interpolationOrders = {0: 'Nearest', 1: 'Bilinear', 3: 'Bicubic'}
+remapInterpolations = {0: cv2.INTER_NEAREST, 1: cv2.INTER_LINEAR, 3: cv2.INTER_CUBIC}
+remapMaxSize = 32766                    # cv2.remap requires sizes lower than SHRT_MAX
+
+#------------------------------------------------------------------
+def coordinatesBox(coords, shape, margin=2):
+    # Bounding box (row1, row2, col1, col2) of coords (2, ...) expanded by margin pixels
+    # and clipped to an image of shape, empty if the coordinates are outside the image
+    low = np.floor(coords.reshape(2, -1).min(axis=1)).astype(int) - margin
+    high = np.ceil(coords.reshape(2, -1).max(axis=1)).astype(int) + margin + 1
+    row1, col1 = np.clip(low, 0, shape[:2])
+    row2, col2 = np.clip(high, 0, shape[:2])
+    return row1, max(row1, row2), col1, max(col1, col2)
+
+def sampleProfileCoordinates(image, coords, order=0):
+    # Values of image at coords (2, linewidth, length) with 0 outside the image,
+    # interpolated with order 0 (nearest), 1 (bilinear) or 3 (bicubic) by a single
+    # cv2.remap call, which reads only the pixels around the coordinates. The coordinates
+    # are laid out as rows of at most remapMaxSize samples, whatever the length of the
+    # profile. Images too large for cv2.remap are cropped to the bounding box of the
+    # coordinates (with a margin covering the interpolation kernels and the spline
+    # prefilter), sampled by map_coordinates (spline interpolation for order 3) only
+    # if the box itself is still too large, so that the cost follows the profile
+    # length and not the image size.
+    shape = coords.shape[1:]
+    if max(image.shape) > remapMaxSize:
+        row1, row2, col1, col2 = coordinatesBox(coords, image.shape, margin=8)
+        if row2 == row1 or col2 == col1:
+            return np.zeros(shape, image.dtype)
+        image = image[row1:row2, col1:col2]
+        coords = coords - np.array([row1, col1], dtype=float).reshape(2, *[1]*len(shape))
+    if max(image.shape) > remapMaxSize:
+        return map_coordinates(image, coords, order=order, mode='constant', cval=0, prefilter=order > 1)
+    rows = coords[0].ravel().astype(np.float32)
+    cols = coords[1].ravel().astype(np.float32)
+    size = rows.size
+    width = min(size, remapMaxSize)
+    height = -(-size // width)
+    pad = height*width - size
+    if pad:
+        rows = np.concatenate([rows, np.zeros(pad, np.float32)])
+        cols = np.concatenate([cols, np.zeros(pad, np.float32)])
+    values = cv2.remap(image, cols.reshape(height, width), rows.reshape(height, width), 
+                       remapInterpolations[order], borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return values.ravel()[:size].reshape(shape)
+
+#------------------------------------------------------------------
+def estimatePeriod(y, minPeriod=2., maxPeriod=None, minCorrelation=0.1):
+    # Dominant period (in samples) of the profile from its autocorrelation computed by FFT:
+    # (nearly) highest local maximum of the autocorrelation (normalized higher than minCorrelation),
+    # at lags between minPeriod and maxPeriod (a quarter of the profile by default, i.e. at
+    # least 4 periods), with a parabolic sub-sample refinement. Undefined values (nan boundaries
+    # of the smoothed profile) are dropped, then variations slower than maxPeriod are removed
+    # by a moving average of 2*maxPeriod+1 samples (extended by its boundary values).
+    # Returns nan without periodic signal.
+    y = np.asarray(y, dtype=float)
+    y = y[np.isfinite(y)]
+    n = len(y)
+    if n < 4:
+        return np.nan
+    maxPeriod = int(min(maxPeriod or n//4, n//2))
+    trend = smoothProfile(y, 2*maxPeriod+1, 'box')
+    valid = np.flatnonzero(np.isfinite(trend))
+    if len(valid) > 0:
+        y = y - np.interp(np.arange(n), valid, trend[valid])
+    else:
+        y = y - y.mean()
+    spectrum = np.fft.rfft(y, 2*n)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum))[:min(maxPeriod, n//2) + 1]
+    if autocorrelation[0] <= 0:
+        return np.nan
+    candidates = findPeaks(autocorrelation, thres=minCorrelation*autocorrelation[0])
+    candidates = candidates[candidates >= minPeriod]
+    if len(candidates) == 0:
+        return np.nan
+    # the first lag close to the highest peak (multiples of a period not integer in samples 
+    # may correlate slightly better than the period itself)
+    heights = autocorrelation[candidates]
+    best = candidates[np.argmax(heights >= 0.8*heights.max())]
+    return refinePeaks(autocorrelation, [best])[0]
+
+#------------------------------------------------------------------
+widthReductions = {'mean': 'Mean', 'median': 'Median', 'trimmed': 'Trimmed mean', 'max': 'Max', 'percentile': 'Percentile'}
+
+#------------------------------------------------------------------
+def reduceProfile(samples, method='mean', percentile=50, trim=0.2):
+    # Profile from the samples (linewidth, length) reduced across the width for all
+    # the positions at once:
+    #   trimmed: mean without the trim fraction of lowest and highest samples of each position
+    #   percentile: percentile of the samples of each position
+    samples = np.asarray(samples, dtype=float)
+    if method == 'mean':
+        return samples.mean(axis=0)
+    elif method == 'median':
+        return np.median(samples, axis=0)
+    elif method == 'trimmed':
+        cut = int(trim * samples.shape[0])
+        if cut == 0:
+            return samples.mean(axis=0)
+        return np.sort(samples, axis=0)[cut:samples.shape[0]-cut].mean(axis=0)
+    elif method == 'max':
+        return samples.max(axis=0)
+    elif method == 'percentile':
+        return np.percentile(samples, percentile, axis=0)
+    raise ValueError("Unknown width reduction: %s" % method)
+
+#------------------------------------------------------------------
+def splinePath(xdata, ydata, step=1.):
+    # Points of a cubic spline through the control points (parameterized by the chord
+    # length) at uniform arc length steps of at most step, with the unit normals 
+    # of the curve at these points, as (cols, rows, normal_cols, normal_rows).
+    # The arc length is integrated on a fine evaluation of the spline then inverted.
+    xdata = np.asarray(xdata, dtype=float)
+    ydata = np.asarray(ydata, dtype=float)
+    chord = np.concatenate([[0.], np.cumsum(np.hypot(np.diff(xdata), np.diff(ydata)))])
+    keep = np.concatenate([[True], np.diff(chord) > 0])         # repeated control points
+    xdata, ydata, chord = xdata[keep], ydata[keep], chord[keep]
+    if len(chord) < 3:
+        return None
+
+    spline = CubicSpline(chord, np.column_stack([xdata, ydata]), bc_type='natural')
+    t = np.linspace(0., chord[-1], int(np.ceil(8*chord[-1])) + 2)
+    xy = spline(t)
+    arc = np.concatenate([[0.], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))])
+    s = np.linspace(0., arc[-1], int(np.ceil(arc[-1]/step)) + 1)
+    t = np.interp(s, arc, t)
+    cols, rows = spline(t).T
+    d_col, d_row = spline(t, 1).T
+    norm = np.maximum(np.hypot(d_col, d_row), 1e-12)
+    return cols, rows, -d_row / norm, d_col / norm
+
+#------------------------------------------------------------------
+def splineCoordinates(xdata, ydata, linewidth=1):
+    # Sampling coordinates of a spline profile as (rows, cols) of shape (2, linewidth, length),
+    # samples at uniform arc length (1 pixel) with lines of linewidth samples following 
+    # the local normal of the curve (polyline sampling with less than 3 distinct control points)
+    path = splinePath(xdata, ydata)
+    if path is None:
+        return profileCoordinates(xdata, ydata, linewidth)
+    cols, rows, normal_col, normal_row = path
+    offsets = np.linspace(-(linewidth-1)/2., (linewidth-1)/2., linewidth)[:,None]
+    return np.stack([rows[None,:] + offsets * normal_row[None,:], 
+                     cols[None,:] + offsets * normal_col[None,:]])
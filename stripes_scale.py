@@ -0,0 +1,260 @@
+
+#=================================================================
+# Scale detection used by StripesCounter
+#=================================================================
+
+import os, re, json, hashlib, fnmatch, queue, tempfile, subprocess
+import numpy as np
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+scaleCacheFileName = os.path.join(os.path.expanduser('~'), '.StripesCounter', 'scales.json')
+
+#------------------------------------------------------------------
+def scaleRegion(image, maxSize=1024, margin=16):
+    # Bounding box (x0, y0, x1, y1) at full resolution of the scale (bar and text drawn
+    # with pure black pixels): the pure black mask is reduced to a coarse level (a block
+    # being black if any of its pixels is) where black pixels close to each other are
+    # merged, the largest connected component giving the region. None without black pixels.
+    mask = cv2.inRange(image, 0, 0)
+    factor = max(1, int(np.ceil(max(image.shape[:2]) / maxSize)))
+    coarse = cv2.resize(mask, (-(-image.shape[1] // factor), -(-image.shape[0] // factor)),
+                        interpolation=cv2.INTER_AREA) if factor > 1 else mask
+    size = max(5, maxSize // 64)
+    coarse = cv2.dilate((coarse > 0).astype(np.uint8), np.ones((size, size), np.uint8))
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(coarse, connectivity=8)
+    if n < 2:
+        return None
+    i = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    x, y, w, h = [int(v) * factor for v in stats[i, :4]]
+    return (max(x - margin, 0), max(y - margin, 0),
+            min(x + w + margin, image.shape[1]), min(y + h + margin, image.shape[0]))
+
+#------------------------------------------------------------------
+def scaleLine(mask):
+    # Longest line of the mask by the fast line detector as (point1, point2, length)
+    fld = cv2.ximgproc.createFastLineDetector()
+    lines = fld.detect(mask)
+    if lines is None:
+        return None, None, 0
+    lines = lines.reshape(-1, 4)
+    lengths = np.hypot(lines[:,2] - lines[:,0], lines[:,3] - lines[:,1])
+    i = np.argmax(lengths)
+    return lines[i, :2], lines[i, 2:], int(lengths[i])
+
+#------------------------------------------------------------------
+def parseScaleText(text):
+    # Scale value in mm from the OCR text
+    matchObj = re.match(r'[^0-9]*([0-9]+(?:\.[0-9]+)?)\s*mm', text.strip())
+    return float(matchObj.group(1))
+
+#------------------------------------------------------------------
+def scaleText(mask):
+    # Scale value read by tesseract on the mask
+    import pytesseract
+
+    return parseScaleText(pytesseract.image_to_string(mask))
+
+#------------------------------------------------------------------
+def scaleMaskAndLine(image):
+    # Mask (black scale on white) of the full resolution crop of the scale region, 
+    # with the line points in image coordinates and its length (0 if not found)
+    region = scaleRegion(image)
+    if region is None:
+        return None, None, None, 0
+    x0, y0, x1, y1 = region
+    mask = cv2.bitwise_not(cv2.inRange(image[y0:y1, x0:x1], 0, 0))
+
+    try:
+        point1, point2, scaleLength = scaleLine(mask)
+        if scaleLength > 0:
+            point1, point2 = point1 + (x0, y0), point2 + (x0, y0)
+    except:
+        point1, point2, scaleLength = None, None, 0
+    return mask, point1, point2, scaleLength
+
+#------------------------------------------------------------------
+def detectScale(image, ocr=None):
+    # Scale value (0. if not read) and length in pixels (0 if not found) with the
+    # line points, from line detection and OCR (by the OCRPool ocr if given) on the 
+    # full resolution crop of the scale region only
+    mask, point1, point2, scaleLength = scaleMaskAndLine(image)
+    if mask is None:
+        return 0., 0, None, None
+
+    try:
+        scaleValue = parseScaleText(ocr.read([mask])[0]) if ocr is not None else scaleText(mask)
+    except:
+        scaleValue = 0.
+
+    return scaleValue, scaleLength, point1, point2
+
+#------------------------------------------------------------------
+class OCRPool:
+    # Long-lived OCR workers: one tesseract API instance per worker thread when tesserocr
+    # is installed (no process started per image), else the images are split in one
+    # batch per worker, each batch read by a single tesseract process from a list of files
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.apis = None
+        try:
+            import tesserocr
+
+            self.apis = queue.Queue()
+            for i in range(self.workers):
+                self.apis.put(tesserocr.PyTessBaseAPI())
+        except:
+            self.apis = None
+
+    def readOne(self, mask):
+        api = self.apis.get()
+        try:
+            mask = np.ascontiguousarray(mask)
+            api.SetImageBytes(mask.tobytes(), mask.shape[1], mask.shape[0], 1, mask.shape[1])
+            return api.GetUTF8Text()
+        finally:
+            self.apis.put(api)
+
+    def readBatch(self, masks):
+        # tesseract separates the texts of the listed images by form feeds
+        import pytesseract
+
+        if len(masks) == 0:
+            return []
+        with tempfile.TemporaryDirectory() as directory:
+            listFileName = os.path.join(directory, 'images.txt')
+            with open(listFileName, 'w') as f:
+                for i, mask in enumerate(masks):
+                    fileName = os.path.join(directory, '%06d.png' % i)
+                    cv2.imwrite(fileName, mask)
+                    f.write(fileName + '\n')
+            output = subprocess.run([pytesseract.pytesseract.tesseract_cmd, listFileName, 'stdout'],
+                                    capture_output=True, text=True, check=True).stdout
+        texts = output.split('\f')
+        return (texts + [''] * len(masks))[:len(masks)]
+
+    def read(self, masks):
+        # Texts of the masks, in the same order
+        masks = list(masks)
+        if self.apis is not None:
+            return list(self.executor.map(self.readOne, masks))
+        bounds = np.linspace(0, len(masks), min(self.workers, max(len(masks), 1)) + 1).astype(int)
+        batches = [masks[bounds[i]:bounds[i+1]] for i in range(len(bounds)-1)]
+        return [text for texts in self.executor.map(self.readBatch, batches) for text in texts]
+
+    def close(self):
+        self.executor.shutdown()
+        while self.apis is not None and not self.apis.empty():
+            self.apis.get().End()
+
+#------------------------------------------------------------------
+def detectScales(fileNames, ocr, workers=None):
+    # Scales of image files as a list of dicts (file, hash, value, length, point1, point2):
+    # images are read and their scale lines detected in parallel, then all the scale 
+    # regions are read at once by the OCRPool ocr
+    def prepare(fileName):
+        image = cv2.imread(fileName, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            return None
+        return (imageHash(image),) + scaleMaskAndLine(image)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        prepared = list(executor.map(prepare, fileNames))
+
+    masks = [p[1] for p in prepared if p is not None and p[1] is not None]
+    try:
+        texts = ocr.read(masks)
+    except:
+        texts = [''] * len(masks)
+    texts = iter(texts)
+
+    results = []
+    for fileName, p in zip(fileNames, prepared):
+        result = {'file': fileName, 'hash': None, 'value': 0., 'length': 0, 'point1': None, 'point2': None}
+        if p is not None:
+            result['hash'], mask, result['point1'], result['point2'], result['length'] = p
+            if mask is not None:
+                try:
+                    result['value'] = parseScaleText(next(texts))
+                except:
+                    result['value'] = 0.
+        results.append(result)
+    return results
+
+#------------------------------------------------------------------
+def imageHash(image):
+    # Hash of the pixels (and shape) of the image as read
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(image.shape).encode())
+    h.update(np.ascontiguousarray(image).data)
+    return h.hexdigest()
+
+#------------------------------------------------------------------
+class ScaleCache:
+    # Persistent scales (value in mm, length in pixels and line points) by image hash,
+    # and scales (value and length) by filename patterns (fnmatch, e.g. "*1.35x*") shared
+    # by the images of a same microscope magnification
+
+    def __init__(self, fileName=scaleCacheFileName):
+        self.fileName = fileName
+        self.images = {}
+        self.patterns = {}
+        self.stored = {'images': {}, 'patterns': {}}    # entries stored since the last save
+        self.mtime = None
+        self.reload()
+
+    def reload(self):
+        # Entries of the file (written by other processes as well), with the entries
+        # stored and not yet saved here
+        try:
+            mtime = os.path.getmtime(self.fileName)
+            with open(self.fileName) as f:
+                content = json.load(f)
+        except:
+            return
+        self.mtime = mtime
+        self.images = dict(content.get('images', {}), **self.stored['images'])
+        self.patterns = dict(content.get('patterns', {}), **self.stored['patterns'])
+
+    def lookup(self, hash, fileName):
+        # Scale of the image, else of the longest (most specific) pattern matching its filename
+        try:
+            if os.path.getmtime(self.fileName) != self.mtime:
+                self.reload()
+        except:
+            pass
+        if hash in self.images:
+            return self.images[hash]
+        name = os.path.basename(fileName)
+        for pattern in sorted(self.patterns, key=len, reverse=True):
+            if fnmatch.fnmatch(name, pattern):
+                return self.patterns[pattern]
+        return None
+
+    def store(self, hash, fileName, value, length, point1=None, point2=None, pattern=None, save=True):
+        entry = {'file': os.path.basename(fileName), 'value': float(value), 'length': float(length)}
+        if point1 is not None and point2 is not None:
+            entry['points'] = [[float(v) for v in point1], [float(v) for v in point2]]
+        self.images[hash] = self.stored['images'][hash] = entry
+        if pattern:
+            self.patterns[pattern] = self.stored['patterns'][pattern] = {'value': float(value), 'length': float(length)}
+        if save:
+            self.save()
+
+    def save(self):
+        # The stored entries merged into the file read again (so that the entries saved by
+        # other processes, as detect_scale.py, are kept), written to a temporary file then
+        # renamed, so that the cache is never left truncated
+        self.reload()
+        try:
+            os.makedirs(os.path.dirname(self.fileName), exist_ok=True)
+            temporary = '%s.%d.tmp' % (self.fileName, os.getpid())
+            with open(temporary, 'w') as f:
+                json.dump({'images': self.images, 'patterns': self.patterns}, f, indent=1)
+            os.replace(temporary, self.fileName)
+            self.mtime = os.path.getmtime(self.fileName)
+            self.stored = {'images': {}, 'patterns': {}}
+        except:
+            pass
@@ -0,0 +1,149 @@
+
+#=================================================================
+# Recording and replay of StripesCounter sessions
+#=================================================================
+
+import sys, time, json, functools
+import numpy as np
+
+#------------------------------------------------------------------
+class SessionRecorder:
+    # Interaction events (name, arguments) of the main window with their times (s)
+    # since the start of the recording, mouse events being kept as data coordinates
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.t0 = 0.
+
+    def start(self, width, height):
+        self.events = []
+        self.t0 = time.perf_counter()
+        self.enabled = True
+        self.record('resize', [width, height])
+
+    def stop(self):
+        self.enabled = False
+
+    def record(self, name, args):
+        if not self.enabled: return
+        self.events.append({'t': time.perf_counter() - self.t0, 'name': name, 'args': args})
+
+    def save(self, fileName):
+        with open(fileName, 'w') as f:
+            json.dump({'version': 1, 'events': self.events}, f, indent=1)
+
+#------------------------------------------------------------------
+recorder = SessionRecorder()
+
+def mouseState(window, event):
+    # Matplotlib mouse event as a dict
+    axes = None
+    if event.inaxes is window.ax0: axes = 'ax0'
+    elif event.inaxes is window.ax1: axes = 'ax1'
+    button = event.button
+    if button is not None and not isinstance(button, str):
+        button = int(button)
+    return {'axes': axes, 'xdata': event.xdata, 'ydata': event.ydata, 'button': button,
+            'key': event.key, 'dblclick': getattr(event, 'dblclick', False), 'step': getattr(event, 'step', 0)}
+
+def eventState(window, arg):
+    # Pick and mouse events as dicts, other arguments as they are
+    if hasattr(arg, 'mouseevent'):
+        return {'pick': arg.artist.get_label(), 'mouse': mouseState(window, arg.mouseevent)}
+    if hasattr(arg, 'inaxes'):
+        return {'mouse': mouseState(window, arg)}
+    return arg
+
+def recorded(name):
+    # Decorator of the methods of the main window whose calls are recorded. Arguments
+    # beyond those of the method (as the checked state sent by the clicked signal of
+    # buttons) are dropped, Qt passing all the signal arguments to such a wrapper.
+    def decorator(func):
+        nargs = func.__code__.co_argcount - 1
+        @functools.wraps(func)
+        def wrapper(self, *args):
+            args = args[:nargs]
+            if recorder.enabled:
+                recorder.record(name, [eventState(self, a) for a in args])
+            return func(self, *args)
+        return wrapper
+    return decorator
+
+#------------------------------------------------------------------
+class ReplayedEvent:
+    pass
+
+def mouseEvent(window, state):
+    # Mouse event rebuilt from its state, with pixel positions from the current axes limits
+    event = ReplayedEvent()
+    event.inaxes = getattr(window, state['axes']) if state['axes'] else None
+    # numpy scalars as the matplotlib events (positions being combined with numpy arrays)
+    event.xdata = np.float64(state['xdata']) if state['xdata'] is not None else None
+    event.ydata = np.float64(state['ydata']) if state['ydata'] is not None else None
+    event.button, event.key = state['button'], state['key']
+    event.dblclick, event.step = state['dblclick'], state['step']
+    event.canvas = window.canvas
+    event.x = event.y = 0
+    if event.inaxes is not None and event.xdata is not None:
+        event.x, event.y = event.inaxes.transData.transform((event.xdata, event.ydata))
+    return event
+
+def pickEvent(window, state):
+    # Pick event of the pickable artist of the image axes with the recorded label
+    event = ReplayedEvent()
+    artists = [a for a in window.ax0.get_children() if a.get_label() == state['pick'] and a.get_picker()]
+    if len(artists) == 0:
+        raise ValueError("no artist %s to pick" % state['pick'])
+    event.artist = artists[0]
+    event.mouseevent = mouseEvent(window, state['mouse'])
+    event.canvas = window.canvas
+    return event
+
+def replayedArgument(window, arg):
+    if isinstance(arg, dict) and 'pick' in arg:
+        return pickEvent(window, arg)
+    if isinstance(arg, dict) and 'mouse' in arg:
+        return mouseEvent(window, arg['mouse'])
+    return arg
+
+def loadSession(fileName):
+    with open(fileName) as f:
+        return json.load(f)['events']
+
+def replaySession(window, events, widgets={}, processEvents=None):
+    # Events replayed in order, as fast as possible: slots listed in widgets are replayed
+    # by setting the value of their widget (as the user did), the other events by calling
+    # the method of their name with the recorded arguments. Events failing are reported
+    # and skipped. Returns the number of failed events.
+    failed = 0
+    for n, event in enumerate(events):
+        name, args = event['name'], event['args']
+        try:
+            args = [replayedArgument(window, a) for a in args]
+            if name == 'resize':
+                window.resize(*args)
+            elif name == 'openImage':
+                window.imageFileName = args[0]
+                window.readImage()
+                window.displayImage()
+            elif name in widgets:
+                widget = getattr(window, widgets[name])
+                if hasattr(widget, 'setCurrentIndex'):
+                    current, setter = widget.currentIndex(), widget.setCurrentIndex
+                elif hasattr(widget, 'setChecked'):
+                    current, setter = widget.isChecked(), widget.setChecked
+                else:
+                    current, setter = widget.value(), widget.setValue
+                if current != args[0]:
+                    setter(args[0])
+                else:
+                    getattr(window, name)(*args)
+            else:
+                getattr(window, name)(*args)
+        except Exception as e:
+            failed += 1
+            print("Replay of event %d (%s) failed: %r" % (n, name, e), file=sys.stderr)
+        if processEvents:
+            processEvents()
+    return failed
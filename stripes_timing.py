@@ -0,0 +1,101 @@
+
+#=================================================================
+# Opt-in timing of the interactive hot paths of StripesCounter
+#=================================================================
+
+import time, json, functools
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+#------------------------------------------------------------------
+class Timings:
+    # Durations (s) of the last maxSamples calls of each instrumented operation,
+    # recorded only when enabled, with their end times for the rates of calls
+
+    def __init__(self, maxSamples=10000):
+        self.enabled = False
+        self.maxSamples = maxSamples
+        self.durations = {}
+        self.ends = {}
+
+    def clear(self):
+        self.durations = {}
+        self.ends = {}
+
+    def record(self, name, duration, end):
+        if name not in self.durations:
+            self.durations[name] = deque(maxlen=self.maxSamples)
+            self.ends[name] = deque(maxlen=self.maxSamples)
+        self.durations[name].append(duration)
+        self.ends[name].append(end)
+
+    @contextmanager
+    def timed(self, name):
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            t1 = time.perf_counter()
+            self.record(name, t1 - t0, t1)
+
+    def wrap(self, name, func):
+        # func timed under name (decorator)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                t1 = time.perf_counter()
+                self.record(name, t1 - t0, t1)
+        return wrapper
+
+    def rate(self, name, window=1.):
+        # Calls per second of name during the last window seconds
+        if name not in self.ends:
+            return 0.
+        now = time.perf_counter()
+        ends = np.asarray(self.ends[name])
+        return np.count_nonzero(ends > now - window) / window
+
+    def histogram(self, name, bins=np.logspace(-4, 1, 21)):
+        # Counts of durations in bins (s), log spaced from 0.1 ms to 10 s by default,
+        # durations out of the bins being counted in the first and last bins
+        durations = np.clip(np.asarray(self.durations[name]), bins[0], bins[-1])
+        counts, edges = np.histogram(durations, bins)
+        return counts, edges
+
+    def summary(self):
+        # Statistics (ms) of each operation
+        summary = {}
+        for name, durations in self.durations.items():
+            d = np.asarray(durations) * 1000.
+            summary[name] = {'count': len(d), 'mean': d.mean(), 'p50': np.percentile(d, 50),
+                             'p95': np.percentile(d, 95), 'max': d.max()}
+        return summary
+
+    def export(self, fileName):
+        # Statistics, histograms and samples of durations as JSON
+        content = {}
+        for name, statistics in self.summary().items():
+            counts, edges = self.histogram(name)
+            content[name] = dict({k: float(v) for k, v in statistics.items()},
+                                 histogram={'edges_ms': list(edges * 1000.), 'counts': counts.tolist()},
+                                 durations_ms=[d * 1000. for d in self.durations[name]])
+        with open(fileName, 'w') as f:
+            json.dump(content, f, indent=1)
+
+#------------------------------------------------------------------
+timings = Timings()
+
+def timed(name):
+    # Decorator of the functions or methods recorded in timings
+    def decorator(func):
+        return timings.wrap(name, func)
+    return decorator
@@ -30,5 +30,11 @@ from shapely.geometry import Point, LineString
 import datetime
 import pandas as pd
 
-import cairo
-import xml.dom.minidom
+from xml.sax.saxutils import quoteattr
+
+from stripes_profile import refinePeaks, findPeaks
+from stripes_detection import detectStripes
+from stripes_scale import detectScale
+from stripes_timing import timings, timed
+from stripes_session import recorder, recorded
+import stripes_memory